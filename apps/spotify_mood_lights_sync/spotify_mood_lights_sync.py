@@ -1,15 +1,32 @@
+import hashlib
+import json
+import mmap
 import numbers
+import os
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from collections import Counter, deque
+from concurrent.futures import BrokenExecutor, Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from appdaemon.plugins.hass.hassapi import Hass
 import math
 import colorsys
+from array import array
 from functools import partial
 
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-from requests.exceptions import ConnectionError
+from typing import Tuple, List, Dict, TypeVar, Callable, Iterable, Optional, NamedTuple, TYPE_CHECKING
 
-from typing import Tuple, List, Dict, TypeVar, Callable, Iterable
+# spotipy and requests take longer to import than the rest of the app, they are imported on first use instead
+if TYPE_CHECKING:
+    import spotipy
+    from spotipy.exceptions import SpotifyException
 
 RGB_Color = Tuple[int, int, int]
 HS_Color = Tuple[int, int]
@@ -17,6 +34,29 @@ Point = Tuple[float, float]
 T = TypeVar('T')
 Num = TypeVar('Num', int, float)
 
+# maximum number of tracks per request supported by the audio features endpoint
+AUDIO_FEATURES_BATCH_SIZE = 100
+# uris without audio features, which make the audio features endpoint reject the whole batch they are part of
+NO_FEATURES_URI_PREFIXES = ('spotify:local:', 'spotify:episode:')
+# upper bound for the number of point-sample pairs evaluated at once by the batch APIs, limits peak memory usage
+BATCH_ELEMENTS = 1 << 20
+# number of pixels of a color map image rendered at once
+IMAGE_BAND_PIXELS = 1 << 18
+# stages of a light change for which latencies are recorded, 'total' spans from receiving the event to the light
+LATENCY_STAGES = ('event', 'search', 'audio_features', 'color_for_point', 'turn_on', 'total')
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+# perceived color difference (CIE76 delta E) that is just noticeable
+JUST_NOTICEABLE_DIFFERENCE = 2.3
+# deviation in seconds between the predicted end of a track and its scheduled color change that is corrected
+TRACK_END_TOLERANCE = 1.0
+
+
+class Room(NamedTuple):
+    """A media player whose tracks are synced to a light."""
+    media_player: str
+    light: Optional[str]
+    mode: str
+
 
 class ColorProfile:
     def color_for_point(self, point: Point) -> RGB_Color:
@@ -28,11 +68,92 @@ class ColorProfile:
         """
         pass
 
+    def color_for_points(self, points) -> any:
+        """Computes RGB color values for a batch of points on the color plane. Requires numpy.
+
+        :param points: array-like of shape (n, 2) with coordinates in the range [0,1]X[0,1]
+
+        :return: numpy array of shape (n, 3) holding the same colors as color_for_point for each input point
+        """
+        import numpy as np
+        return np.array([self.color_for_point(tuple(p)) for p in points], dtype=np.uint8).reshape(-1, 3)
+
+    def fingerprint(self) -> Optional[str]:
+        """Identifies the colors produced by this profile. Profiles with equal fingerprints produce the same colors.
+
+        :return: hex digest of the profile parameters, or None if the profile cannot be identified
+        """
+        return None
+
+
+def squared_distance(a: Point, b: Point) -> float:
+    # mirrored by the batch APIs, so that both select the same samples
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    return dx * dx + dy * dy
+
+
+class SampleGrid:
+    """Uniform grid over sample points for nearest neighbor and radius queries. Cells hold about two samples each, so
+    that a query only visits the samples close to the query point."""
+    points: List[Point]
+    cells_per_axis: int
+    cell_size: float
+    cells: Dict[Tuple[int, int], List[int]]
+
+    def __init__(self, points: List[Point]):
+        self.points = points
+        self.min_x = min(p[0] for p in points)
+        self.min_y = min(p[1] for p in points)
+        extent = max(max(p[0] for p in points) - self.min_x, max(p[1] for p in points) - self.min_y, 1E-9)
+        self.cells_per_axis = max(1, math.ceil(math.sqrt(len(points) / 2)))
+        self.cell_size = extent / self.cells_per_axis
+        self.cells = {}
+        for i, p in enumerate(points):
+            self.cells.setdefault(self.cell_of(p), []).append(i)
+
+    def cell_of(self, point: Point) -> Tuple[int, int]:
+        n = self.cells_per_axis - 1
+        return (min(max(int((point[0] - self.min_x) / self.cell_size), 0), n),
+                min(max(int((point[1] - self.min_y) / self.cell_size), 0), n))
+
+    def ring(self, center: Tuple[int, int], r: int) -> Iterable[int]:
+        """:return: the indices of the samples in the cells at a Chebyshev distance of r cells from the center cell"""
+        cx, cy = center
+        for x in range(max(cx - r, 0), min(cx + r, self.cells_per_axis - 1) + 1):
+            for y in (range(max(cy - r, 0), cy + r + 1) if abs(x - cx) == r else (cy - r, cy + r)):
+                yield from self.cells.get((x, y), ())
+
+    def nearest(self, point: Point, k: int) -> List[Tuple[float, int]]:
+        """:return: squared distance and index of the k nearest samples, ordered by distance and then by index"""
+        center = self.cell_of(point)
+        candidates = []
+        for r in range(self.cells_per_axis):
+            candidates.extend((squared_distance(point, self.points[i]), i) for i in self.ring(center, r))
+            # samples in the remaining rings are at least r cells away, the margin guards against rounding
+            if len(candidates) >= k:
+                candidates.sort()
+                if candidates[k - 1][0] < (r * self.cell_size) ** 2 * (1 - 1E-9):
+                    break
+        candidates.sort()
+        return candidates[:k]
+
+    def within(self, point: Point, radius2: float) -> List[int]:
+        """:return: the indices of the samples whose squared distance from the point is at most radius2"""
+        center = self.cell_of(point)
+        # samples in ring r are at least r - 1 cells away, one more ring guards against rounding
+        rings = min(int(math.sqrt(radius2) / self.cell_size) + 3, self.cells_per_axis)
+        return [i for r in range(rings) for i in self.ring(center, r)
+                if squared_distance(point, self.points[i]) <= radius2]
+
 
 class RGBColorProfile(ColorProfile):
     points: List[Point]
     local_weights: List[float]
     channels: Tuple[List[int], List[int], List[int]]
+    neighbors: Optional[int]
+    cutoff: Optional[float]
+    grid: Optional[SampleGrid] = None
 
     def __init__(self, config: Dict):
         self.global_weight = config.get('global_weight', 1.0)
@@ -43,6 +164,55 @@ class RGBColorProfile(ColorProfile):
                          [x.get('color', (255, 255, 255))[1] for x in samples],
                          [x.get('color', (255, 255, 255))[2] for x in samples])
 
+        # optionally only interpolate the k nearest samples and the samples that are not negligible compared to the
+        # nearest sample, which are found with a spatial index instead of visiting all samples
+        self.neighbors = config.get('neighbors')
+        self.cutoff = config.get('cutoff')
+        if (self.neighbors or self.cutoff) and self.points:
+            self.grid = SampleGrid(self.points)
+        # a sample farther away than the square root of this factor times the distance of the nearest sample has less
+        # than cutoff times its weight, if their local weights are equal
+        exponent = self.global_weight * min(self.local_weights, default=1.0)
+        self.cutoff_factor2 = (self.cutoff ** (-1 / exponent)) ** 2 if self.cutoff and exponent > 0 else math.inf
+
+    def fingerprint(self) -> Optional[str]:
+        neighborhood = [] if self.grid is None else [self.neighbors, self.cutoff]
+        return digest('rgb', float(self.global_weight), [[float(v) for v in p] for p in self.points],
+                      [float(w) for w in self.local_weights], [[int(v) for v in c] for c in self.channels],
+                      *neighborhood)
+
+    def nearby_samples(self, point: Point) -> List[int]:
+        """:return: the ascending indices of the samples that are interpolated for a point"""
+        candidates = self.grid.nearest(point, self.neighbors or 1)
+        if self.cutoff_factor2 == math.inf:
+            selected = [i for _, i in candidates]
+        else:
+            radius2 = candidates[0][0] * self.cutoff_factor2
+            if self.neighbors:
+                selected = [i for d2, i in candidates if d2 <= radius2]
+            else:
+                selected = self.grid.within(point, radius2)
+        return sorted(selected)
+
+    def neighborhood_error(self, resolution: int = 32) -> float:
+        """Compares the colors interpolated from the nearby samples against the colors interpolated from all samples on
+        a grid of resolution X resolution points. Requires numpy.
+
+        :return: the largest perceived color difference, 0 if all samples are interpolated
+        """
+        if self.grid is None:
+            return 0.0
+        import numpy as np
+
+        exact = RGBColorProfile({'global_weight': self.global_weight, 'sample_data': [
+            {'point': p, 'color': c, 'local_weight': w}
+            for p, c, w in zip(self.points, zip(*self.channels), self.local_weights)]})
+        axis = np.linspace(0.0, 1.0, resolution)
+        xs, ys = np.meshgrid(axis, axis)
+        points = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        return max(color_difference(tuple(a), tuple(b)) for a, b in
+                   zip(self.color_for_points(points).tolist(), exact.color_for_points(points).tolist()))
+
     def color_for_point(self, point: Point) -> RGB_Color:
         def mul_array(list_a: Iterable[Num], list_b: Iterable[float]) -> List[float]:
             return [ab[0] * ab[1] for ab in zip(list_a, list_b)]
@@ -54,17 +224,68 @@ class RGBColorProfile(ColorProfile):
         def interpolate(values: List[Num], weights: List[float]):
             return sum(mul_array(values, weights)) / sum(weights)
 
-        precomputed_weights = inverse_distance_weights(point, self.points, self.local_weights,
+        points, local_weights, channels = self.points, self.local_weights, self.channels
+        if self.grid is not None:
+            selected = self.nearby_samples(point)
+            points = [points[i] for i in selected]
+            local_weights = [local_weights[i] for i in selected]
+            channels = tuple([channel[i] for i in selected] for channel in channels)
+
+        precomputed_weights = inverse_distance_weights(point, points, local_weights,
                                            global_weight=self.global_weight)
 
         # compute new RGB value as inverse distance weighted sum:
-        red = interpolate(self.channels[0], precomputed_weights)
-        green = interpolate(self.channels[1], precomputed_weights)
-        blue = interpolate(self.channels[2], precomputed_weights)
+        red = interpolate(channels[0], precomputed_weights)
+        green = interpolate(channels[1], precomputed_weights)
+        blue = interpolate(channels[2], precomputed_weights)
 
         # brightness should be max to not conflict with the light's brightness setting (equivalent to HS space)
         return to_max_brightness((int(red), int(green), int(blue)))
 
+    def color_for_points(self, points) -> any:
+        import numpy as np
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        samples = np.asarray(self.points, dtype=float).reshape(-1, 2)
+        exponents = self.global_weight * np.asarray(self.local_weights, dtype=float)
+        channels = np.asarray(self.channels, dtype=float).T
+
+        # the nearby samples of each point are found with the grid, so that only their distances are computed
+        selections = None if self.grid is None else [self.nearby_samples((x, y)) for x, y in points.tolist()]
+        width = len(samples) if selections is None else max(map(len, selections), default=1)
+
+        colors = np.empty((len(points), 3))
+        chunk = max(1, BATCH_ELEMENTS // max(1, width))
+        for start in range(0, len(points), chunk):
+            p = points[start:start + chunk]
+            if selections is None:
+                dx = p[:, 0, None] - samples[:, 0]
+                dy = p[:, 1, None] - samples[:, 1]
+                weights = 1 / (np.hypot(dx, dy) + 1E-6) ** exponents
+                colors[start:start + chunk] = (weights @ channels) / weights.sum(axis=1, keepdims=True)
+                continue
+
+            # selections of different lengths are padded with the first sample, which gets a weight of 0
+            lengths = np.fromiter(map(len, selections[start:start + chunk]), dtype=int, count=len(p))
+            valid = np.arange(width) < lengths[:, None]
+            selected = np.zeros((len(p), width), dtype=int)
+            selected[valid] = np.fromiter((i for s in selections[start:start + chunk] for i in s), dtype=int,
+                                          count=int(lengths.sum()))
+            dx = p[:, 0, None] - samples[selected, 0]
+            dy = p[:, 1, None] - samples[selected, 1]
+            weights = np.where(valid, 1 / (np.hypot(dx, dy) + 1E-6) ** exponents[selected], 0.0)
+            colors[start:start + chunk] = (np.einsum('ij,ijk->ik', weights, channels[selected]) /
+                                           weights.sum(axis=1, keepdims=True))
+
+        result = to_max_brightness_batch(colors.astype(int))
+
+        # rounding differs slightly from the scalar path, which only matters where the int truncation is ambiguous
+        fraction = colors - np.floor(colors)
+        for i in np.flatnonzero(np.any((fraction < 1E-6) | (fraction > 1 - 1E-6), axis=1)):
+            result[i] = self.color_for_point((points[i][0], points[i][1]))
+
+        return result
+
 
 class HSColorProfile(ColorProfile):
     mirror_x: bool
@@ -77,7 +298,9 @@ class HSColorProfile(ColorProfile):
         self.mirror_y = config.get('mirror_y', False)
         self.rotation = config.get('rotation', 0)
         self.drop_off = config.get('drop_off', 1)
-        pass
+
+    def fingerprint(self) -> Optional[str]:
+        return digest('hs', bool(self.mirror_x), bool(self.mirror_y), float(self.rotation), float(self.drop_off))
 
     def color_for_point(self, point: Point) -> RGB_Color:
         point = (normalize(point[0], 0.0, 1.0, -1.0, 1.0),
@@ -93,7 +316,920 @@ class HSColorProfile(ColorProfile):
         distance = min(math.dist([0.0, 0.0], point), 1.0) ** self.drop_off
         saturation = normalize(distance, 0, 1, 0, 100)
 
-        return hs_to_rgb((int(hue), int(saturation)))
+        # same as hs_to_rgb((int(hue), int(saturation))), a hue of 360 only occurs due to rounding and equals 0
+        i = ((int(hue) % 360) * 101 + int(saturation)) * 3
+        table = hs_rgb_table()
+        return table[i], table[i + 1], table[i + 2]
+
+    def color_for_points(self, points) -> any:
+        import numpy as np
+
+        # mirrors color_for_point operation by operation
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        px = normalize(points[:, 0], 0.0, 1.0, -1.0, 1.0)
+        py = normalize(points[:, 1], 0.0, 1.0, -1.0, 1.0)
+        x = px * (-1.0 if self.mirror_x else 1.0)
+        y = py * (-1.0 if self.mirror_y else 1.0)
+        angle = np.degrees(np.arctan2(y, x)) + self.rotation
+        hue = (angle + 360) % 360
+
+        radius = np.hypot(px, py)
+        distance = np.minimum(radius, 1.0) ** self.drop_off
+        saturation = normalize(distance, 0, 1, 0, 100)
+
+        table = np.frombuffer(hs_rgb_table(), dtype=np.uint8).reshape(360, 101, 3)
+        result = table[hue.astype(int) % 360, saturation.astype(int)]
+
+        # atan2, hypot and the degree conversion of numpy may differ slightly from math, which only matters where the
+        # int truncation is ambiguous. Saturations clamped to the unit circle or without drop off are exact.
+        hue_fraction = hue - np.floor(hue)
+        saturation_fraction = saturation - np.floor(saturation)
+        exact_saturation = (radius > 1.0 + 1E-9) | (self.drop_off == 0)
+        ambiguous = ((hue_fraction < 1E-6) | (hue_fraction > 1 - 1E-6) |
+                     ~exact_saturation & ((saturation_fraction < 1E-6) | (saturation_fraction > 1 - 1E-6)))
+        for i in np.flatnonzero(ambiguous):
+            result[i] = self.color_for_point((points[i][0], points[i][1]))
+
+        return result
+
+
+class LUTColorProfile(ColorProfile):
+    """Wraps another color profile by sampling it onto a regular grid once. Colors are then looked up by bilinear
+    interpolation, making lookups independent of the cost of the wrapped profile. Requires numpy for sampling."""
+    profile: ColorProfile
+    size: int
+    table: array
+
+    def __init__(self, profile: ColorProfile, size: int = 64, table: Optional[bytes] = None):
+        """
+        :param profile: the profile to sample
+        :param size: number of grid points per axis
+        :param table: a table previously sampled from the same profile and size, skips sampling the profile
+        """
+        assert size >= 2
+        self.profile = profile
+        self.size = size
+
+        if table is not None:
+            assert len(table) == size * size * 3
+            self.table = array('B', table)
+            return
+
+        import numpy as np
+
+        # row-major grid with the energy axis along the rows, stored as flat bytes [r, g, b, r, g, b, ...]
+        axis = np.linspace(0.0, 1.0, size)
+        xs, ys = np.meshgrid(axis, axis)
+        colors = profile.color_for_points(np.stack([xs.ravel(), ys.ravel()], axis=1))
+        self.table = array('B', colors.astype(np.uint8).tobytes())
+
+    def fingerprint(self) -> Optional[str]:
+        fingerprint = self.profile.fingerprint()
+        return None if fingerprint is None else digest('lut', fingerprint, self.size)
+
+    def color_for_point(self, point: Point) -> RGB_Color:
+        n = self.size - 1
+        x = min(max(point[0], 0.0), 1.0) * n
+        y = min(max(point[1], 0.0), 1.0) * n
+        x0 = min(int(x), n - 1)
+        y0 = min(int(y), n - 1)
+        fx = x - x0
+        fy = y - y0
+
+        i00 = (y0 * self.size + x0) * 3
+        i01 = i00 + self.size * 3
+        t = self.table
+        color = [(t[i00 + c] * (1.0 - fx) + t[i00 + 3 + c] * fx) * (1.0 - fy) +
+                 (t[i01 + c] * (1.0 - fx) + t[i01 + 3 + c] * fx) * fy for c in range(3)]
+
+        return to_max_brightness((round(color[0]), round(color[1]), round(color[2])))
+
+    def color_for_points(self, points) -> any:
+        import numpy as np
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = self.size - 1
+        x = np.clip(points[:, 0], 0.0, 1.0) * n
+        y = np.clip(points[:, 1], 0.0, 1.0) * n
+        x0 = np.minimum(x.astype(int), n - 1)
+        y0 = np.minimum(y.astype(int), n - 1)
+        fx = (x - x0)[:, None]
+        fy = (y - y0)[:, None]
+
+        t = np.frombuffer(self.table, dtype=np.uint8).reshape(self.size, self.size, 3).astype(float)
+        color = ((t[y0, x0] * (1.0 - fx) + t[y0, x0 + 1] * fx) * (1.0 - fy) +
+                 (t[y0 + 1, x0] * (1.0 - fx) + t[y0 + 1, x0 + 1] * fx) * fy)
+
+        return to_max_brightness_batch(np.round(color).astype(int))
+
+    def max_error(self, resolution: int = 256) -> int:
+        """Compares the lookup table against the wrapped profile on a grid of resolution X resolution points.
+
+        :return: the largest deviation of any color channel
+        """
+        import numpy as np
+
+        axis = np.linspace(0.0, 1.0, resolution)
+        xs, ys = np.meshgrid(axis, axis)
+        points = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        exact = self.profile.color_for_points(points).astype(int)
+        return int(np.abs(self.color_for_points(points).astype(int) - exact).max())
+
+
+def load_lut_color_profile(profile: ColorProfile, size: int, location: str) -> LUTColorProfile:
+    """Loads the lookup table of a profile from a file, if the file was saved for the same profile and size.
+    Otherwise the profile is sampled and the table is saved to the file, unless the profile has no fingerprint.
+
+    :raises OSError: if the table could not be saved
+    """
+
+    fingerprint = profile.fingerprint()
+    key = None if fingerprint is None else digest('lut', fingerprint, size).encode() + b'\n'
+    if key is not None and os.path.isfile(location):
+        with open(location, 'rb') as f:
+            data = f.read()
+        if data.startswith(key) and len(data) == len(key) + size * size * 3:
+            return LUTColorProfile(profile, size, data[len(key):])
+
+    lut = LUTColorProfile(profile, size)
+    if key is not None:
+        with open(location + '.tmp', 'wb') as f:
+            f.write(key + lut.table.tobytes())
+        os.replace(location + '.tmp', location)
+    return lut
+
+
+class PersistentCache:
+    """Key-value cache with expiring entries and least-recently-used eviction, stored in a single SQLite file.
+    Values must be json serializable. Safe to use from multiple threads."""
+    max_size: int
+    ttl: float
+    table: str
+
+    def __init__(self, location: str = ':memory:', max_size: int = 10000, ttl: float = 30 * 24 * 3600,
+                 table: str = 'cache'):
+        """
+        :param location: path of the database file, ':memory:' for a cache that is not persisted
+        :param max_size: maximum number of entries before the least recently used entries are evicted
+        :param ttl: default lifetime of an entry in seconds
+        :param table: name of the table holding the entries, allows multiple caches to share a file
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.table = table
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(location, check_same_thread=False, isolation_level=None)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute(f'CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)')
+
+    def get(self, key: str, default=None):
+        """:return: the cached value for the key, or the default if there is no such entry or it expired"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            if row[1] < now:
+                self.db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return default
+            self.db.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value, ttl: Optional[float] = None) -> None:
+        """Stores a value for the key, which expires after ttl seconds or the default lifetime of the cache."""
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.db.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)',
+                            (key, json.dumps(value), expires, now))
+            overflow = len(self) - self.max_size
+            if overflow > 0:
+                self.db.execute(f'DELETE FROM {self.table} WHERE expires < ?', (now,))
+                overflow = len(self) - self.max_size
+            if overflow > 0:
+                self.db.execute(f'DELETE FROM {self.table} WHERE key IN '
+                                f'(SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)', (overflow,))
+
+    def __len__(self) -> int:
+        return self.db.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def items(self) -> List[Tuple[str, any]]:
+        """:return: all keys and values that did not expire, without marking them as accessed"""
+        with self.lock:
+            rows = self.db.execute(f'SELECT key, value FROM {self.table} WHERE expires >= ?', (time.time(),)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def search_key(title: str, artist: str) -> str:
+    """Normalizes a title and artist pair for use as a cache key."""
+    return ' '.join(artist.casefold().split()) + '\n' + ' '.join(title.casefold().split())
+
+
+# metadata that differs between sources of the same recording, e.g. "Song (feat. B) - Remastered 2011"
+TRACK_DECORATION = re.compile(
+    r'[(\[][^)\]]*\b(feat|ft|featuring|with|remaster|remastered|version|edit|mono|stereo|bonus|deluxe)\b[^)\]]*[)\]]'
+    r'|\s-\s.*\b(remaster|remastered|version|edit|mono|stereo|feat|ft|featuring)\b.*$'
+    r'|\s(feat|ft|featuring)\b.*$')
+ARTIST_SEPARATOR = re.compile(r'\s*(?:[,;&/]|\b(?:and|x|feat|ft|featuring)\b\.?)\s*')
+# digits and roman numerals up to 39, which number parts, volumes and sequels
+TRACK_NUMBER = re.compile(r'\b(?:\d+|(?=[ivx]+\b)x{0,3}(?:ix|iv|v?i{0,3}))\b')
+
+
+def normalize_track_text(text: str) -> str:
+    """Removes decorations like featured artists and remaster notes, accents, punctuation and case from a title or
+    artist."""
+    text = TRACK_DECORATION.sub(' ', text.casefold()).replace("'", '').replace('\u2019', '')
+    text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
+
+def track_numbers(text: str) -> Tuple[str, ...]:
+    """:return: the numbers in a normalized title, e.g. ('2',) for 'another brick in the wall pt 2'"""
+    return tuple(str(int(n)) if n.isdigit() else n for n in TRACK_NUMBER.findall(text))
+
+
+def trigrams(text: str) -> set:
+    """:return: the set of character trigrams of a normalized text, padded to weigh the start of the text"""
+    text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(a: set, b: set) -> float:
+    """:return: the Dice coefficient of two trigram sets, 1 for equal texts and 0 for texts without common trigrams"""
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 1.0
+
+
+class TrackIndex:
+    """In-memory index of resolved tracks for matching titles and artists that differ slightly from the ones seen
+    before, e.g. in punctuation or in featured artists. Titles are matched through trigram postings, so that only
+    tracks sharing parts of the title are compared. Titles only match if their numbers are equal, as these tell apart
+    parts and sequels whose titles are otherwise similar. Safe to use from multiple threads."""
+    max_size: int
+    min_similarity: float
+
+    def __init__(self, min_similarity: float = 0.85, max_size: int = 10000):
+        """
+        :param min_similarity: minimum similarity of both the title and the artist for a match, between 0 and 1
+        :param max_size: maximum number of entries before the oldest entries are removed
+        """
+        self.min_similarity = min_similarity
+        self.max_size = max_size
+        # (title, artist) -> (track uri, title trigrams, artist trigrams), ordered from oldest to newest
+        self.entries: Dict[Tuple[str, str], Tuple[str, set, set]] = {}
+        self.postings: Dict[str, set] = {}  # title trigram -> (title, artist) keys
+        self.lock = threading.Lock()
+
+    def add(self, title: str, artist: str, track_uri: str) -> None:
+        """Adds a track under its title and each of its artists."""
+        title = normalize_track_text(title)
+        if not title:
+            return
+        title_trigrams = trigrams(title)
+        artists = {normalize_track_text(a) for a in ARTIST_SEPARATOR.split(artist) + [artist]} - {''}
+        with self.lock:
+            for artist in artists:
+                key = (title, artist)
+                if key in self.entries:
+                    del self.entries[key]  # re-insert as the newest entry
+                self.entries[key] = (track_uri, title_trigrams, trigrams(artist))
+                for trigram in title_trigrams:
+                    self.postings.setdefault(trigram, set()).add(key)
+
+            while len(self.entries) > self.max_size:
+                key = next(iter(self.entries))
+                for trigram in self.entries.pop(key)[1]:
+                    self.postings[trigram].discard(key)
+                    if not self.postings[trigram]:
+                        del self.postings[trigram]
+
+    def match(self, title: str, artist: str) -> Optional[Tuple[str, float]]:
+        """:return: the uri of the most similar track and its similarity, or None if no track is similar enough"""
+        title = normalize_track_text(title)
+        title_trigrams = trigrams(title)
+        title_numbers = track_numbers(title)
+        artist_trigrams = [trigrams(a) for a in {normalize_track_text(a) for a in ARTIST_SEPARATOR.split(artist) +
+                                                 [artist]} - {''}]
+        if not title:
+            return None
+
+        with self.lock:
+            shared = Counter()
+            for trigram in title_trigrams:
+                shared.update(self.postings.get(trigram, ()))
+
+            best = None
+            for key, count in shared.items():
+                if track_numbers(key[0]) != title_numbers:
+                    continue
+                track_uri, entry_title, entry_artist = self.entries[key]
+                title_similarity = 2 * count / (len(title_trigrams) + len(entry_title))
+                if title_similarity < self.min_similarity:
+                    continue
+                artist_similarity = max((similarity(a, entry_artist) for a in artist_trigrams), default=0.0)
+                score = min(title_similarity, artist_similarity)
+                if score >= self.min_similarity and (best is None or score > best[1]):
+                    best = (track_uri, score)
+            return best
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def index_cached_search(index: TrackIndex, key: str, entry: dict) -> None:
+    """Adds a search cache entry to a track index under the searched title and artist, and under the name and artists
+    of the found track if these are known."""
+    if not entry.get('uri'):
+        return
+    artist, _, title = key.partition('\n')
+    index.add(title, artist, entry['uri'])
+    if entry.get('name'):
+        for name in entry.get('artists') or ['']:
+            index.add(entry['name'], name, entry['uri'])
+
+
+# binary layout of feature dataset files: a header followed by the tracks sorted by id and the searches sorted by the
+# hash of their search key, so that both can be looked up by binary search without reading the file into memory
+DATASET_MAGIC = b'SMLSFEAT'
+DATASET_HEADER = struct.Struct('<8sIII')  # magic, version, number of tracks, number of searches
+DATASET_TRACK = struct.Struct('<22sff')  # track id, valence, energy
+DATASET_SEARCH = struct.Struct('<8s22s')  # hash of the search key, track id
+
+
+def dataset_search_hash(title: str, artist: str) -> bytes:
+    return hashlib.blake2b(search_key(title, artist).encode(), digest_size=8).digest()
+
+
+def write_feature_dataset(tracks: Iterable[Tuple[str, str, Iterable[str], float, float]], location: str) -> int:
+    """Writes a feature dataset file, which can then be used by FeatureDataset. If a track id or a title and artist
+    pair occurs multiple times, the first occurrence is used.
+
+    :param tracks: tuples of spotify track id, title, artists, valence and energy
+    :param location: path of the dataset file
+    :return: the number of tracks written
+    """
+
+    features: Dict[bytes, Tuple[float, float]] = {}
+    searches: Dict[bytes, bytes] = {}
+    for track_id, title, artists, valence, energy in tracks:
+        track_id = track_id.encode('ascii')
+        features.setdefault(track_id, (valence, energy))
+        for artist in artists:
+            searches.setdefault(dataset_search_hash(title, artist), track_id)
+        # title only searches are used as a fallback, as done with the Spotify API
+        searches.setdefault(dataset_search_hash(title, ''), track_id)
+
+    with open(location, 'wb') as f:
+        f.write(DATASET_HEADER.pack(DATASET_MAGIC, 1, len(features), len(searches)))
+        for track_id in sorted(features):
+            f.write(DATASET_TRACK.pack(track_id, *features[track_id]))
+        for key in sorted(searches):
+            f.write(DATASET_SEARCH.pack(key, searches[key]))
+
+    return len(features)
+
+
+class FeatureDataset:
+    """Read-only lookup of track features and searches in a dataset file written by write_feature_dataset. The file is
+    memory-mapped, so only the pages touched by the binary searches are read. Safe to use from multiple threads."""
+    track_count: int
+    search_count: int
+
+    def __init__(self, location: str):
+        """:raises ValueError: if the file is not a feature dataset"""
+        with open(location, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, self.track_count, self.search_count = DATASET_HEADER.unpack_from(self.data)
+        except struct.error:
+            magic = version = None
+        if magic != DATASET_MAGIC or version != 1 or len(self.data) != (
+                DATASET_HEADER.size + self.track_count * DATASET_TRACK.size +
+                self.search_count * DATASET_SEARCH.size):
+            self.data.close()
+            raise ValueError(f"'{location}' is not a valid feature dataset")
+
+        self.searches_offset = DATASET_HEADER.size + self.track_count * DATASET_TRACK.size
+
+    def find(self, offset: int, count: int, record: struct.Struct, key: bytes) -> Optional[int]:
+        """:return: the offset of the record starting with the key in a sorted section of the file, if present"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * record.size
+            if self.data[start:start + len(key)] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = offset + lo * record.size
+        return start if lo < count and self.data[start:start + len(key)] == key else None
+
+    def features(self, track_uri: str) -> Optional[Tuple[float, float]]:
+        """:return: the valence and energy of a spotify track uri or id, or None if the track is not in the dataset"""
+        try:
+            track_id = track_uri.rsplit(':', 1)[-1].encode('ascii').ljust(22, b'\0')
+        except UnicodeEncodeError:
+            return None
+        if len(track_id) != 22:
+            return None
+
+        start = self.find(DATASET_HEADER.size, self.track_count, DATASET_TRACK, track_id)
+        if start is None:
+            return None
+        _, valence, energy = DATASET_TRACK.unpack_from(self.data, start)
+        # undo the rounding to single precision, datasets do not have more than 6 decimals
+        return round(valence, 6), round(energy, 6)
+
+    def search(self, title: str, artist: str) -> Optional[str]:
+        """:return: the spotify track uri for a title and artist, or None if the pair is not in the dataset. Pass an
+        empty artist to search by title only."""
+        start = self.find(self.searches_offset, self.search_count, DATASET_SEARCH, dataset_search_hash(title, artist))
+        if start is None:
+            return None
+        return 'spotify:track:' + DATASET_SEARCH.unpack_from(self.data, start)[1].rstrip(b'\0').decode('ascii')
+
+    def close(self) -> None:
+        self.data.close()
+
+
+class TokenBucket:
+    """Limits the rate of events to a number of events per second, while allowing short bursts. Safe to use from
+    multiple threads."""
+    rate: float
+    capacity: float
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: number of events per second, unlimited if not positive
+        :param capacity: maximum number of events in a burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, waiting until one is available.
+
+        :return: the time in seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate > 0:
+                    self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and (self.rate <= 0 or self.tokens >= 1):
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.rate > 0 else 0)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Withholds all tokens for the given number of seconds."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def paused_for(self) -> float:
+        """:return: the time in seconds until tokens are given out again after a pause, 0 if not paused"""
+        with self.lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service while its circuit breaker is open."""
+
+
+class RateLimitedError(CircuitOpenError):
+    """Raised instead of calling a service while it has asked to pause requests for longer than a caller waits."""
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while. After failure_threshold consecutive failures the circuit opens and
+    calls are rejected for reset_timeout seconds. Afterwards, the circuit is half-open and lets a single trial call
+    through, which closes the circuit if it succeeds and opens it again if it fails. Safe to use from multiple
+    threads."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    failure_threshold: int
+    reset_timeout: float
+    state: str
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        """
+        :param failure_threshold: number of consecutive failures that open the circuit, never opens if not positive
+        :param reset_timeout: seconds until a trial call is let through, also the time allowed for a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.changed = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """:return: whether a call may be made now"""
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self.changed < self.reset_timeout:
+                return False
+            # also lets another trial call through if the previous one never reported its result
+            self.state = CircuitBreaker.HALF_OPEN
+            self.changed = now
+            return True
+
+    def record_success(self) -> bool:
+        """:return: whether the circuit was closed by this success"""
+        with self.lock:
+            closed = self.state != CircuitBreaker.CLOSED
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            return closed
+
+    def record_failure(self) -> bool:
+        """:return: whether the circuit was opened by this failure"""
+        with self.lock:
+            self.failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN or self.state == CircuitBreaker.CLOSED and
+                    0 < self.failure_threshold <= self.failures):
+                self.state = CircuitBreaker.OPEN
+                self.changed = time.monotonic()
+                return True
+            return False
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls with the same key. While a call is in flight, further calls with the same key
+    wait for it and share its result or exception instead of calling again. Safe to use from multiple threads."""
+    shared: int
+
+    def __init__(self):
+        self.calls: Dict[any, Future] = {}
+        self.shared = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, func: Callable[[], T]) -> Tuple[T, bool]:
+        """Calls func, unless a call with the same key is in flight, whose result is returned instead.
+
+        :return: the result of the call and whether it was shared with a concurrent call
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class LatencyStats:
+    """Keeps the most recent durations of each stage of a light change to compute rolling percentiles. Safe to use
+    from multiple threads."""
+    window: int
+    samples: Dict[str, deque]
+    counts: Counter
+    sums: Dict[str, float]
+
+    def __init__(self, window: int = 1000):
+        """:param window: number of most recent durations per stage the percentiles are computed from"""
+        self.window = window
+        self.samples = {}
+        self.counts = Counter()
+        self.sums = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self.counts[stage] += 1
+            self.sums[stage] = self.sums.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, stage: str):
+        """Records the duration of a block of code, including blocks that raise."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def percentiles(self, stage: str) -> Dict[float, float]:
+        """:return: the nearest-rank percentiles of the recent durations of a stage in seconds, empty if none were
+        recorded"""
+        with self.lock:
+            samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return {}
+        return {q: samples[max(0, math.ceil(q * len(samples)) - 1)] for q in LATENCY_QUANTILES}
+
+    def prometheus_text(self, app: str, stats: Counter) -> str:
+        """Formats the latencies as summaries and the event counters as counters in the Prometheus text format."""
+
+        lines = ['# HELP spotify_mood_lights_sync_latency_seconds Duration of the stages of a light change.',
+                 '# TYPE spotify_mood_lights_sync_latency_seconds summary']
+        for stage in LATENCY_STAGES:
+            labels = f'app="{app}",stage="{stage}"'
+            for q, value in self.percentiles(stage).items():
+                lines.append(f'spotify_mood_lights_sync_latency_seconds{{{labels},quantile="{q}"}} {value!r}')
+            with self.lock:
+                total, count = self.sums.get(stage, 0.0), self.counts[stage]
+            lines.append(f'spotify_mood_lights_sync_latency_seconds_sum{{{labels}}} {total!r}')
+            lines.append(f'spotify_mood_lights_sync_latency_seconds_count{{{labels}}} {count}')
+
+        lines += ['# HELP spotify_mood_lights_sync_events_total Number of events, e.g. retries or dropped lookups.',
+                  '# TYPE spotify_mood_lights_sync_events_total counter']
+        for event, count in sorted(stats.items()):
+            lines.append(f'spotify_mood_lights_sync_events_total{{app="{app}",event="{event}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+RATE_LIMITERS: Dict[str, TokenBucket] = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def shared_rate_limiter(key: str, rate: float, capacity: float) -> TokenBucket:
+    """Gets the token bucket shared by all apps using the same key, e.g. the same Spotify client id. The bucket keeps
+    the rate and capacity of the first app, so that all apps stay limited together. Callers should compare them with
+    their own settings."""
+    with RATE_LIMITERS_LOCK:
+        bucket = RATE_LIMITERS.get(key)
+        if bucket is None:
+            bucket = RATE_LIMITERS[key] = TokenBucket(rate, capacity)
+        return bucket
+
+
+CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {}
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def shared_circuit_breaker(key: str, failure_threshold: int, reset_timeout: float) -> CircuitBreaker:
+    """Gets the circuit breaker shared by all apps using the same key, e.g. the same Spotify client id. The breaker
+    keeps the settings of the first app, so that all apps pause their requests together. Callers should compare them
+    with their own settings."""
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.get(key)
+        if breaker is None:
+            breaker = CIRCUIT_BREAKERS[key] = CircuitBreaker(failure_threshold, reset_timeout)
+        return breaker
+
+
+SINGLE_FLIGHTS: Dict[str, SingleFlight] = {}
+SINGLE_FLIGHTS_LOCK = threading.Lock()
+
+
+def shared_single_flight(key: str) -> SingleFlight:
+    """Gets the single-flight group shared by all apps using the same key, e.g. the same Spotify client id."""
+    with SINGLE_FLIGHTS_LOCK:
+        return SINGLE_FLIGHTS.setdefault(key, SingleFlight())
+
+
+SPOTIFY_CLIENTS: Dict[Tuple[str, str], 'spotipy.Spotify'] = {}
+SPOTIFY_CLIENTS_LOCK = threading.Lock()
+
+
+def shared_spotify_client(client_id: str, client_secret: str) -> 'spotipy.Spotify':
+    """Gets the Spotify client shared by all apps using the same credentials, which share a single access token and
+    the connection pool of a single session."""
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+    from requests import Session
+
+    with SPOTIFY_CLIENTS_LOCK:
+        client = SPOTIFY_CLIENTS.get((client_id, client_secret))
+        if client is None:
+            client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
+            # retries are handled by call_spotify instead of the session
+            client = spotipy.Spotify(client_credentials_manager=client_credentials_manager,
+                                     requests_session=Session())
+            SPOTIFY_CLIENTS[(client_id, client_secret)] = client
+        return client
+
+
+def spotify_errors() -> Tuple[type, type]:
+    """:return: the ConnectionError of requests and the SpotifyException of spotipy, raised by failed Spotify API
+    requests. Like spotipy, they are imported on first use"""
+    from requests.exceptions import ConnectionError
+    from spotipy.exceptions import SpotifyException
+
+    return ConnectionError, SpotifyException
+
+
+def retry_after(e: 'SpotifyException') -> Optional[float]:
+    """:return: the delay in seconds requested by the Retry-After header of a failed request, if present"""
+    try:
+        return float(e.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(NamedTuple):
+    """Retries of failed Spotify requests, with an exponentially growing, randomized delay."""
+    max_retries: int = 1
+    base_delay: float = 0.5
+    max_delay: float = 30
+
+
+def call_spotify(func: Callable[[], T], retry: RetryPolicy, rate_limiter: TokenBucket, circuit_breaker: CircuitBreaker,
+                 warn: Callable[[str], None], log: Callable[[str], None], count: Callable[[str], None]) -> T:
+    """Calls the Spotify API, retrying connection errors, rate limited requests and server errors up to max_retries
+    times with exponential backoff. The rate limiter and circuit breaker are usually shared by all callers using the
+    same client id. The circuit breaker rejects requests with a CircuitOpenError without calling Spotify after
+    repeated connection and server errors. The delay requested by rate limited responses is recorded on the rate
+    limiter, and requests are rejected with a RateLimitedError while it is longer than max_delay.
+
+    :param warn: logs warnings about failed requests
+    :param log: logs that Spotify is available again
+    :param count: counts events like 'retries' or 'throttled_requests'
+    """
+    ConnectionError, SpotifyException = spotify_errors()
+
+    retries = retry.max_retries
+    while True:
+        if not circuit_breaker.allow():
+            count('rejected_requests')
+            raise CircuitOpenError("circuit breaker of the Spotify API is open")
+        paused = rate_limiter.paused_for()
+        if paused > retry.max_delay:
+            count('rejected_requests')
+            raise RateLimitedError(f"Spotify API asked to pause requests for {paused:.0f} more seconds")
+        if rate_limiter.acquire() > 0:
+            count('throttled_requests')
+
+        try:
+            result = func()
+        except (ConnectionError, SpotifyException) as e:
+            if isinstance(e, ConnectionError) or e.http_status >= 500:
+                if circuit_breaker.record_failure():
+                    warn(f"Spotify API failed {circuit_breaker.failures} time(s) in a row. Pausing requests for "
+                         f"{circuit_breaker.reset_timeout} seconds. Reason: {e}")
+                    raise e
+            elif circuit_breaker.record_success():  # rate limited and client errors are valid responses
+                log("Spotify API is available again, resuming requests")
+            if isinstance(e, SpotifyException) and e.http_status != 429 and e.http_status < 500:
+                raise e
+            delay = retry_after(e) if isinstance(e, SpotifyException) else None
+            # honor the delay requested by spotify, which also holds back the requests of other apps
+            if delay is not None:
+                rate_limiter.pause(delay)
+            if retries == 0 or delay is not None and delay > retry.max_delay:
+                raise e
+
+            if isinstance(e, ConnectionError):
+                warn(f"Could not reach Spotify API, retrying {retries} more time(s)")
+            else:
+                warn(f"Spotify API responded with status {e.http_status}, retrying {retries} more time(s)")
+            count('retries')
+
+            if delay is None:
+                backoff = retry.base_delay * 2 ** (retry.max_retries - retries)
+                time.sleep(random.uniform(0, min(retry.max_delay, backoff)))
+            retries -= 1
+        else:
+            if circuit_breaker.record_success():
+                log("Spotify API is available again, resuming requests")
+            return result
+
+
+def request_search(call: Callable[[Callable[[], T]], T], sp: 'spotipy.Spotify', title: str, artist: str,
+                   log: Callable[[str], None]) -> dict:
+    """Searches Spotify for a title and artist, falling back to searching just by title.
+
+    :param call: calls the Spotify API, e.g. call_spotify with the settings of the caller
+    :return: search cache entry holding the uri of the best match, which is None if no track was found
+    """
+
+    results = call(partial(sp.search, q=f'artist:{artist} track:{title}', type='track'))
+    if len(results['tracks']['items']) == 0:
+        log(f"Could not find track id for '{title}' by '{artist}'. Searching just by title...")
+        results = call(partial(sp.search, q=f'track:{title}', type='track'))
+
+    items = results['tracks']['items']
+    if len(items) == 0:
+        return {'uri': None}
+    # the name and artists of the track are kept as well, so that the fuzzy index can be rebuilt from the cache
+    return {'uri': items[0]['uri'], 'name': items[0].get('name'),
+            'artists': [a.get('name') for a in items[0].get('artists', ()) if a.get('name')]}
+
+
+def request_audio_features(call: Callable[[Callable[[], T]], T], sp: 'spotipy.Spotify',
+                           track_uris: List[str]) -> List[Optional[List[float]]]:
+    """Requests the features of up to AUDIO_FEATURES_BATCH_SIZE tracks from Spotify.
+
+    :param call: calls the Spotify API, e.g. call_spotify with the settings of the caller
+    :return: the valence and energy of each track, None for tracks without features
+    """
+    return [[features['valence'], features['energy']] if features else None
+            for features in call(partial(sp.audio_features, track_uris))]
+
+
+def find_track_uri(title: str, artist: str, search_cache: PersistentCache,
+                   search: Optional[Callable[[str, str], dict]], negative_ttl: float,
+                   feature_dataset: Optional[FeatureDataset] = None,
+                   index: Optional[TrackIndex] = None) -> Tuple[Optional[str], Optional[float]]:
+    """Finds the track uri for a title and artist in the feature dataset, the search cache and the fuzzy index of the
+    tracks found before, and finally with search. Search results are cached, including unsuccessful searches, and
+    added to the index. Matches of the index are not cached, so that a wrong match is not kept for the cache ttl.
+
+    :param search: searches Spotify and returns a search cache entry, e.g. request_search. Only the dataset, cache
+    and index are used if None
+    :return: the track uri of the best match, or None if no track was found, and the similarity of tracks matched by
+    the index, None for all other tracks
+    """
+
+    if feature_dataset is not None:
+        track_uri = feature_dataset.search(title, artist) or feature_dataset.search(title, '')
+        if track_uri is not None:
+            return track_uri, None
+
+    key = search_key(title, artist)
+    cached = search_cache.get(key)
+    if cached is not None and cached['uri']:
+        return cached['uri'], None
+
+    # tracks found before under a slightly different title or artist are matched locally
+    match = index.match(title, artist) if index is not None else None
+    if match is not None:
+        return match
+    if cached is not None or search is None:
+        return None, None
+
+    entry = search(title, artist)
+    if entry['uri'] is None:
+        search_cache.put(key, entry, ttl=negative_ttl)
+        return None, None
+
+    search_cache.put(key, entry)
+    if index is not None:
+        index_cached_search(index, key, entry)
+    return entry['uri'], None
+
+
+def find_track_features(track_uris: Iterable[str], feature_cache: PersistentCache,
+                        request: Optional[Callable[[List[str]], List[Optional[List[float]]]]],
+                        feature_dataset: Optional[FeatureDataset] = None) -> Dict[str, Tuple[float, float]]:
+    """Gets the valence and energy of multiple tracks from the feature dataset and cache. Missing tracks are requested
+    in batches of up to AUDIO_FEATURES_BATCH_SIZE tracks, whose results are cached. Local files and episodes have no
+    features and are never requested.
+
+    :param request: requests the features of a batch of tracks, e.g. request_audio_features. Only the dataset and
+    cache are used if None
+    :return: the features by track uri, tracks without features are left out
+    """
+
+    features = {}
+    missing = []
+    for track_uri in dict.fromkeys(track_uris):
+        found = feature_dataset.features(track_uri) if feature_dataset is not None else None
+        found = found or feature_cache.get(track_uri)
+        if found is not None:
+            features[track_uri] = (found[0], found[1])
+        elif request is not None and not track_uri.startswith(NO_FEATURES_URI_PREFIXES):
+            missing.append(track_uri)
+
+    for start in range(0, len(missing), AUDIO_FEATURES_BATCH_SIZE):
+        batch = missing[start:start + AUDIO_FEATURES_BATCH_SIZE]
+        for track_uri, found in zip(batch, request(batch)):
+            if found is not None:
+                features[track_uri] = (found[0], found[1])
+                feature_cache.put(track_uri, found)
+
+    return features
+
+
+def digest(*parts) -> str:
+    """Computes a stable hex digest of json serializable values."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
 
 
 def normalize(v: float, in_min: float, in_max: float, out_min: float, out_max: float) -> float:
@@ -106,6 +1242,20 @@ def hs_to_rgb(color: HS_Color) -> RGB_Color:
     return int(color[0] * 255), int(color[1] * 255), int(color[2] * 255)
 
 
+HS_RGB_TABLE: Optional[bytes] = None
+
+
+def hs_rgb_table() -> bytes:
+    """Precomputes hs_to_rgb for all integer hues in [0, 360) and saturations in [0, 100] on first use.
+
+    :return: the rgb colors as flat bytes, the color of hue h and saturation s starts at index (h * 101 + s) * 3
+    """
+    global HS_RGB_TABLE
+    if HS_RGB_TABLE is None:
+        HS_RGB_TABLE = bytes(c for h in range(360) for s in range(101) for c in hs_to_rgb((h, s)))
+    return HS_RGB_TABLE
+
+
 def to_max_brightness(color: RGB_Color) -> RGB_Color:
     """Maximizes the brightness of the given rgb color."""
     hsv = colorsys.rgb_to_hsv(color[0] / 255.0, color[1] / 255.0, color[2] / 255.0)
@@ -113,26 +1263,161 @@ def to_max_brightness(color: RGB_Color) -> RGB_Color:
     return int(rgb[0] * 255), int(rgb[1] * 255), int(rgb[2] * 255)
 
 
-def create_color_map_image(color_profile: ColorProfile, size: int) -> any:
-    """Creates an image of the color map in use.
+def rgb_to_lab(color: RGB_Color) -> Tuple[float, float, float]:
+    """Converts from srgb to the perceptually uniform CIELAB color space, using the D65 white point."""
+    def linearize(c: float) -> float:
+        c = c / 255.0
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+    def f(t: float) -> float:
+        return t ** (1 / 3) if t > (6 / 29) ** 3 else t / (3 * (6 / 29) ** 2) + 4 / 29
+
+    r, g, b = linearize(color[0]), linearize(color[1]), linearize(color[2])
+    x = f((0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047)
+    y = f(0.2126 * r + 0.7152 * g + 0.0722 * b)
+    z = f((0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883)
+    return 116 * y - 16, 500 * (x - y), 200 * (y - z)
+
+
+def color_difference(color_a: RGB_Color, color_b: RGB_Color) -> float:
+    """Computes the perceived difference of two rgb colors as CIE76 delta E. A difference of about 2.3 is just
+    noticeable."""
+    return math.dist(rgb_to_lab(color_a), rgb_to_lab(color_b))
+
+
+def to_max_brightness_batch(colors) -> any:
+    """Maximizes the brightness of an array of shape (n, 3) of rgb colors. Produces the same values as
+    to_max_brightness, which is mirrored operation by operation here. Requires numpy."""
+    import numpy as np
+
+    rgb = np.asarray(colors, dtype=float).reshape(-1, 3) / 255.0
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    grey = minc == maxc
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(grey, 0.0, rangec / maxc)
+        rc = (maxc - r) / rangec
+        gc = (maxc - g) / rangec
+        bc = (maxc - b) / rangec
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0.0, (h / 6.0) % 1.0)
+
+    i = (h * 6.0).astype(int)
+    f = (h * 6.0) - i
+    v = np.ones_like(h)
+    p = 1.0 - s
+    q = 1.0 - s * f
+    t = 1.0 - s * (1.0 - f)
+    i = i % 6
+    result = np.stack([np.choose(i, [v, q, p, p, t, v]),
+                       np.choose(i, [t, v, v, q, p, p]),
+                       np.choose(i, [p, p, t, v, v, q])], axis=1)
+    return (result * 255).astype(np.uint8)
+
+
+def render_band(color_profile: ColorProfile, size: int, pixels, start: int, end: int) -> None:
+    """Renders the rows [start, end) of a color map image into an array of shape (size, size, 3). Requires numpy."""
+    import numpy as np
+
+    step = 1.0 / (size - 1)
+    xs, rows = np.meshgrid(np.arange(size), np.arange(start, end))
+    # the first image row holds the highest energy
+    points = np.stack([xs.ravel() * step, (size - 1 - rows.ravel()) * step], axis=1)
+    pixels[start:end] = color_profile.color_for_points(points).reshape(end - start, size, 3)
+
+
+def render_shared_band(color_profile: ColorProfile, size: int, name: str, start: int, end: int) -> None:
+    """Renders rows of a color map image into the shared memory block of the given name, run by worker processes."""
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    buffer = shared_memory.SharedMemory(name=name)
+    try:
+        render_band(color_profile, size, np.ndarray((size, size, 3), dtype=np.uint8, buffer=buffer.buf), start, end)
+    finally:
+        buffer.close()
+
+
+def create_color_map_image(color_profile: ColorProfile, size: int, workers: int = 1) -> any:
+    """Creates an image of the color map in use. The image is rendered in bands of rows, which limits the memory
+    used for large images and allows rendering the bands in parallel. Requires numpy and Pillow.
 
     :param color_profile: The profile from which to sample colors
     :param size: height and width of the output image in pixels
+    :param workers: number of processes rendering the bands into shared memory, rendered in this process if 1
 
     :return: Pillow image object of the given color profile
     """
 
+    import numpy as np
     from PIL import Image
-    im = Image.new('RGB', (size, size))
-    for y in range(0, size):
-        for x in range(0, size):
-            p_y = normalize(y, 0, size - 1, 0.0, 1.0)
-            p_x = normalize(x, 0, size - 1, 0.0, 1.0)
-            color = color_profile.color_for_point((p_x, p_y))
-            im.putpixel((x, -y), color)
-    return im
+
+    rows_per_band = max(1, IMAGE_BAND_PIXELS // size)
+    bands = [(start, min(start + rows_per_band, size)) for start in range(0, size, rows_per_band)]
+
+    if workers <= 1 or len(bands) == 1:
+        pixels = np.empty((size, size, 3), dtype=np.uint8)
+        for start, end in bands:
+            render_band(color_profile, size, pixels, start, end)
+        return Image.fromarray(pixels)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    buffer = shared_memory.SharedMemory(create=True, size=size * size * 3)
+    try:
+        # spawned instead of forked, forking a process running other threads is unsafe
+        with ProcessPoolExecutor(min(workers, len(bands)), mp_context=multiprocessing.get_context('spawn')) as pool:
+            for future in [pool.submit(render_shared_band, color_profile, size, buffer.name, start, end)
+                           for start, end in bands]:
+                future.result()
+        return Image.fromarray(np.ndarray((size, size, 3), dtype=np.uint8, buffer=buffer.buf).copy())
+    finally:
+        buffer.close()
+        buffer.unlink()
 
 
+def save_color_map_image(color_profile: ColorProfile, size: int, location: str, workers: int = 1) -> bool:
+    """Saves an image of the color map in use, unless the existing file at the location was created from the same
+    color profile and size. The fingerprint of the image is stored next to it in a '.hash' file.
+
+    :param color_profile: The profile from which to sample colors
+    :param size: height and width of the output image in pixels
+    :param location: path to which the image should be saved
+    :param workers: number of processes rendering the image
+
+    :return: False if the existing image was up-to-date, True otherwise
+    """
+
+    fingerprint = color_profile.fingerprint()
+    key = None if fingerprint is None else digest(fingerprint, size)
+    hash_location = f'{location}.hash'
+
+    if key is not None and os.path.isfile(location) and os.path.isfile(hash_location):
+        with open(hash_location) as f:
+            if f.read().strip() == key:
+                return False
+
+    create_color_map_image(color_profile, size, workers).save(location)
+    if key is not None:
+        with open(hash_location, 'w') as f:
+            f.write(key)
+    elif os.path.isfile(hash_location):
+        os.remove(hash_location)
+    return True
+
+
+# compiled color profiles by the hash of their configuration, shared by all apps in the process
+COMPILED_PROFILES: Dict[str, ColorProfile] = {}
+COMPILED_PROFILES_LOCK = threading.Lock()
+
+# serializes the generation of color map images, e.g. if an app is reloaded while its image is still being generated
+IMAGE_LOCK = threading.Lock()
+
 PROFILE_DEFAULT = RGBColorProfile({
     'global_weight': 2,
     'sample_data': [
@@ -176,237 +1461,916 @@ PROFILE_SATURATED = HSColorProfile({
 })
 
 
+def parse_custom_profile(custom_profile, warn: Callable[[str], None]) -> ColorProfile:
+    """Parses the 'custom_profile' config of the app. Problems are reported through warn, falling back to the default
+    profile if the config can not be used."""
+
+    def parse_legacy() -> RGBColorProfile:
+        data = [{'point': x['point'], 'color': x['color'], 'local_weight': 1.0} for x in custom_profile]
+
+        assert len(data) > 0
+        assert all([len(x['point']) == 2 and len(x['color']) == 3 and
+                    0 <= x['point'][0] <= 1 and 0 <= x['point'][1] <= 1 and
+                    0 <= x['color'][0] <= 255 and 0 <= x['color'][1] <= 255 and 0 <= x['color'][2] <= 255
+                    for x in data])
+
+        return RGBColorProfile({
+            'global_weight': 1.0,
+            'sample_data': data
+        })
+
+    def parse_rgb() -> RGBColorProfile:
+        config = {
+            'global_weight': custom_profile.get('global_weight', 1.0),
+            'sample_data': [{
+                'point': x['point'],
+                'color': x['color'],
+                'local_weight': x.get('local_weight', 1.0)
+            } for x in custom_profile['sample_data']],
+            'neighbors': custom_profile.get('neighbors'),
+            'cutoff': custom_profile.get('cutoff'),
+        }
+
+        assert len(config['sample_data']) > 0
+        assert all([(isinstance(x['local_weight'], numbers.Number) and
+                     len(x['point']) == 2 and len(x['color']) == 3 and
+                     0 <= x['point'][0] <= 1 and 0 <= x['point'][1] <= 1 and
+                     0 <= x['color'][0] <= 255 and 0 <= x['color'][1] <= 255 and 0 <= x['color'][2] <= 255)
+                    for x in config['sample_data']])
+        assert config['neighbors'] is None or isinstance(config['neighbors'], int) and config['neighbors'] > 0
+        assert config['cutoff'] is None or isinstance(config['cutoff'], numbers.Number) and 0 < config['cutoff'] < 1
+
+        # the combined weight of the many distant samples that are ignored is only negligible for large exponents
+        profile = RGBColorProfile(config)
+        try:
+            error = profile.neighborhood_error() if profile.grid is not None else 0.0
+        except ModuleNotFoundError:
+            error = 0.0  # the comparison requires numpy, which is optional
+        if error > JUST_NOTICEABLE_DIFFERENCE:
+            warn(f"'neighbors' and 'cutoff' noticeably change the colors of the profile, by a color difference of up "
+                 f"to {error:.1f}. Consider a larger 'global_weight', more 'neighbors', a smaller 'cutoff' or a "
+                 f"'color_lookup_table' instead")
+
+        return profile
+
+    def parse_hs() -> HSColorProfile:
+        config = {
+            'mirror_x': custom_profile.get('mirror_x', False),
+            'mirror_y': custom_profile.get('mirror_y', False),
+            'rotation': custom_profile.get('rotation', 0),
+            'drop_off': custom_profile.get('drop_off', 1),
+        }
+
+        assert isinstance(config['mirror_x'], bool)
+        assert isinstance(config['mirror_y'], bool)
+        assert isinstance(config['rotation'], numbers.Number)
+        assert config['drop_off'] >= 0
+
+        return HSColorProfile(config)
+
+    try:
+        if type(custom_profile) is list:  # legacy config, assume RGB values without weights
+            warn("Using deprecated custom_profile config format. See README for new format.")
+            return parse_legacy()
+        elif custom_profile:
+            mode = custom_profile.get('color_mode')
+            if mode == 'rgb':
+                return parse_rgb()
+            elif mode == 'hs':
+                return parse_hs()
+            else:
+                warn(f"Unknown color mode '{mode}' in 'custom_profile'. Must be 'rgb' or 'hs'. Falling back to the"
+                     f" default profile")
+                return PROFILE_DEFAULT
+        else:
+            warn("Profile set to 'custom' but no 'custom_profile' specified in app config. Falling back"
+                 " to the default profile")
+            return PROFILE_DEFAULT
+    except (KeyError, AssertionError):
+        warn("Profile set to 'custom' but 'custom_profile' is malformed. Falling back to the default"
+             " profile")
+        return PROFILE_DEFAULT
+
+
+def parse_color_profile(args: Dict, warn: Callable[[str], None]) -> ColorProfile:
+    """Builds the color profile configured by the 'color_profile', 'custom_profile' and 'color_lookup_table' options of
+    the app config, including its lookup table. Problems are reported through warn.
+
+    :param args: app config
+    :param warn: called with a message for every problem in the config
+    :return: the configured color profile
+    """
+
+    color_profile_arg = args.get('color_profile', 'default')
+    if color_profile_arg == 'default' or color_profile_arg == 'centered':  # legacy option for centered
+        color_profile = PROFILE_DEFAULT
+    elif color_profile_arg == 'saturated':
+        color_profile = PROFILE_SATURATED
+    elif color_profile_arg == 'custom':
+        color_profile = parse_custom_profile(args.get('custom_profile'), warn)
+    else:
+        warn(f"Unknown profile '{color_profile_arg}'. Falling back to the default profile")
+        color_profile = PROFILE_DEFAULT
+
+    # optionally sample the color profile into a lookup table for constant time lookups
+    color_lookup_table = args.get('color_lookup_table')
+    if color_lookup_table is not None:
+        size = color_lookup_table.get('size', 64)
+        location = color_lookup_table.get('location')
+        if not isinstance(size, int) or size < 2:
+            warn(f"Invalid 'color_lookup_table' size '{size}'. Must be an integer of at least 2. Using the exact color "
+                 f"profile")
+        elif location:
+            try:
+                color_profile = load_lut_color_profile(color_profile, size, location)
+            except OSError as e:
+                warn(f"Could not save color lookup table to '{location}'. Reason: {e.strerror}")
+                color_profile = LUTColorProfile(color_profile, size)
+        else:
+            color_profile = LUTColorProfile(color_profile, size)
+
+    return color_profile
+
+
 class SpotifyMoodLightsSync(Hass):
     """SpotifyMoodLightsSync class."""
 
-    light: str
-    sp: spotipy.Spotify
-    max_retries: int
+    rooms: Dict[str, Room]
+    client_id: str
+    client_secret: str
+    retry: RetryPolicy
+    rate_limiter: TokenBucket
+    circuit_breaker: CircuitBreaker
+    single_flight: SingleFlight
+    fallback_color: Optional[RGB_Color]
     color_profile: ColorProfile
+    feature_cache: Optional[PersistentCache] = None
+    search_cache: Optional[PersistentCache] = None
+    search_negative_ttl: float
+    search_index: Optional[TrackIndex] = None
+    search_index_args: Optional[dict] = None
+    feature_dataset: Optional[FeatureDataset] = None
+    dataset_api_fallback: bool
+    prefetch_max_tracks: int
+    context_attribute: Optional[str]
+    predict_next_track: bool
+    context_tracks: Dict[str, List[str]]
+    predicted_colors: Dict[str, Tuple[str, str, RGB_Color]]
+    schedule_next_track: bool
+    track_end_timers: Dict[str, Tuple[str, datetime, Optional[str]]]
+    early_tracks: Dict[str, str]
+    executor: Optional[ThreadPoolExecutor] = None
+    generations: Dict[str, int]
+    stats: Counter
+    latency: LatencyStats
+    latency_entity: Optional[str] = None
+    latency_file: Optional[str] = None
+    search_debounce: float
+    pending_searches: Dict[str, str]
+    resolved_searches: Dict[str, Tuple[str, str]]
+    min_color_difference: float
+    last_colors: Dict[str, RGB_Color]
+    image_task: Optional[Future] = None
+    startup_time: float
 
     def initialize(self) -> None:
         """Initialize the app and listen for media_player media_content_id changes."""
 
+        start = time.perf_counter()
+
         # setup light
-        self.light = self.args.get('light')
-        if not self.light:
+        if 'rooms' not in self.args and not self.args.get('light'):
             self.error("'light' not specified in app config", level='WARNING')
 
         # setup spotify component
-        client_id = self.args.get('client_id')
-        if not client_id:
+        self.client_id = self.args.get('client_id')
+        if not self.client_id:
             self.error("Spotify 'client_id' not specified in app config. Aborting startup", level='ERROR')
             return
 
-        client_secret = self.args.get('client_secret')
-        if not client_secret:
+        self.client_secret = self.args.get('client_secret')
+        if not self.client_secret:
             self.error("Spotify 'client_secret' not specified in app config. Aborting startup", level='ERROR')
             return
 
-        client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-        self.sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-
-        self.max_retries = self.args.get('max_retries', 1)
+        self.retry = RetryPolicy(self.args.get('max_retries', 1), self.args.get('retry_base_delay', 0.5),
+                                 self.args.get('retry_max_delay', 30))
+        rate_limit, rate_limit_burst = self.args.get('rate_limit', 10), self.args.get('rate_limit_burst', 20)
+        self.rate_limiter = shared_rate_limiter(self.client_id, rate_limit, rate_limit_burst)
+        if (self.rate_limiter.rate, self.rate_limiter.capacity) != (rate_limit, rate_limit_burst):
+            self.error(f"'rate_limit' {rate_limit} and 'rate_limit_burst' {rate_limit_burst} differ from the settings "
+                       f"of another app using the same 'client_id'. Using its rate limit of {self.rate_limiter.rate} "
+                       f"with bursts of {self.rate_limiter.capacity} instead. Restart AppDaemon to apply changed "
+                       f"settings", level='WARNING')
+
+        # setup circuit breaker, tracks are not looked up for a while if Spotify keeps failing
+        circuit_breaker = self.args.get('circuit_breaker', {})
+        failure_threshold = circuit_breaker.get('failure_threshold', 5)
+        reset_timeout = circuit_breaker.get('reset_timeout', 60)
+        self.circuit_breaker = shared_circuit_breaker(self.client_id, failure_threshold, reset_timeout)
+        settings = (self.circuit_breaker.failure_threshold, self.circuit_breaker.reset_timeout)
+        if settings != (failure_threshold, reset_timeout):
+            self.error(f"'circuit_breaker' settings differ from those of another app using the same 'client_id'. "
+                       f"Using its 'failure_threshold' of {self.circuit_breaker.failure_threshold} and "
+                       f"'reset_timeout' of {self.circuit_breaker.reset_timeout} instead. Restart AppDaemon to apply "
+                       f"changed settings", level='WARNING')
+        # concurrent requests for the same track, e.g. from grouped speakers, are sent to Spotify only once
+        self.single_flight = shared_single_flight(self.client_id)
+
+        self.fallback_color = self.args.get('fallback_color')
+        if self.fallback_color is not None:
+            if (isinstance(self.fallback_color, (list, tuple)) and len(self.fallback_color) == 3 and
+                    all(isinstance(c, int) and 0 <= c <= 255 for c in self.fallback_color)):
+                self.fallback_color = tuple(self.fallback_color)
+            else:
+                self.error(f"Invalid 'fallback_color' {self.fallback_color}. Must be a list of three integers between "
+                           f"0 and 255. No fallback color is used", level='WARNING')
+                self.fallback_color = None
+
+        # setup worker pool for spotify lookups, lookups run on the callback thread if no workers are configured.
+        # multiple rooms share the callback thread of the app, so they get a worker each by default
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.stats = Counter()
+        rooms = self.args.get('rooms')
+        room_count = len(rooms) if isinstance(rooms, list) else 1
+        worker_threads = self.args.get('worker_threads', room_count if room_count > 1 else 0)
+        self.executor = ThreadPoolExecutor(worker_threads, thread_name_prefix=self.name) if worker_threads else None
+
+        # setup latency statistics, published periodically as a sensor and optionally as a prometheus metrics file
+        latency_stats = self.args.get('latency_stats')
+        if latency_stats is True:
+            latency_stats = {}
+        elif not latency_stats and not isinstance(latency_stats, dict):
+            latency_stats = None
+        elif not isinstance(latency_stats, dict):
+            self.error(f"Invalid 'latency_stats' {latency_stats}. Must be True or an object. Latency statistics are "
+                       f"not published", level='WARNING')
+            latency_stats = None
+        self.latency = LatencyStats(latency_stats.get('window', 1000) if latency_stats is not None else 1000)
+        if latency_stats is not None:
+            self.latency_entity = latency_stats.get('entity', f'sensor.{self.name}_latency')
+            self.latency_file = latency_stats.get('prometheus_file')
+            self.run_every(self.publish_latency, 'now', latency_stats.get('interval', 60))
+
+        # setup coalescing of search mode state changes
+        self.search_debounce = self.args.get('search_debounce', 0)
+        self.pending_searches = {}
+        self.resolved_searches = {}
+
+        # setup suppression of color changes that are too small to notice
+        self.min_color_difference = self.args.get('min_color_difference', 0)
+        self.last_colors = {}
+
+        # setup cache of track features, kept in memory unless a location is given
+        feature_cache = self.args.get('feature_cache', {})
+        location = feature_cache.get('location', ':memory:')
+        try:
+            self.feature_cache = PersistentCache(location, feature_cache.get('max_size', 10000),
+                                                 feature_cache.get('ttl', 30 * 24 * 3600))
+        except sqlite3.Error as e:
+            self.error(f"Could not open feature cache at '{location}'. Falling back to an in-memory cache. "
+                       f"Reason: {e}", level='WARNING')
+            self.feature_cache = PersistentCache()
+
+        # setup cache of search results, tracks that could not be found are cached for a shorter time
+        search_cache = self.args.get('search_cache', {})
+        location = search_cache.get('location', ':memory:')
+        self.search_negative_ttl = search_cache.get('negative_ttl', 24 * 3600)
+        try:
+            self.search_cache = PersistentCache(location, search_cache.get('max_size', 10000),
+                                                search_cache.get('ttl', 30 * 24 * 3600), table='searches')
+        except sqlite3.Error as e:
+            self.error(f"Could not open search cache at '{location}'. Falling back to an in-memory cache. "
+                       f"Reason: {e}", level='WARNING')
+            self.search_cache = PersistentCache(table='searches')
+
+        # setup fuzzy matching of searches against the tracks found before, built from the search cache on first use
+        fuzzy_search = self.args.get('fuzzy_search', False)
+        self.search_index = None
+        self.search_index_args = None
+        if fuzzy_search:
+            fuzzy_search = {} if fuzzy_search is True else fuzzy_search
+            self.search_index_args = {'min_similarity': fuzzy_search.get('min_similarity', 0.85),
+                                      'max_size': search_cache.get('max_size', 10000)}
+
+        # setup offline dataset of track features, for clients that cannot use the audio features endpoint
+        feature_dataset = self.args.get('feature_dataset', {})
+        self.feature_dataset = None
+        self.dataset_api_fallback = feature_dataset.get('api_fallback', True)
+        if feature_dataset:
+            try:
+                self.feature_dataset = FeatureDataset(feature_dataset['location'])
+            except KeyError:
+                self.error("'feature_dataset' specified without a 'location'. Using the Spotify API instead",
+                           level='WARNING')
+            except (OSError, ValueError) as e:
+                self.error(f"Could not open feature dataset. Using the Spotify API instead. Reason: {e}",
+                           level='WARNING')
 
         # setup color profile
-        color_profile_arg = self.args.get('color_profile', 'default')
-        if color_profile_arg == 'default' or color_profile_arg == 'centered':  # legacy option for centered
-            self.color_profile = PROFILE_DEFAULT
-        elif color_profile_arg == 'saturated':
-            self.color_profile = PROFILE_SATURATED
-        elif color_profile_arg == 'custom':
-            self.color_profile = self.parse_custom_profile()
-        else:
-            self.error(f"Unknown profile '{color_profile_arg}'. Falling back to the default profile",
-                       level='WARNING')
-            self.color_profile = PROFILE_DEFAULT
+        self.color_profile = self.compile_color_profile()
+        color_lookup_table = self.args.get('color_lookup_table')
+        if isinstance(self.color_profile, LUTColorProfile) and color_lookup_table.get('report_error', False):
+            self.log(f"Color lookup table of size {self.color_profile.size} deviates from the exact color profile "
+                     f"by at most {self.color_profile.max_error()} per color channel")
 
-        # output color map as image for debugging
+        # output color map as image for debugging, generated in the background to not delay the startup
         color_map_image = self.args.get("color_map_image")
         if color_map_image is not None:
             size = color_map_image.get('size')
             location = color_map_image.get('location')
             if size and location:
-                im = create_color_map_image(self.color_profile, size)
-                try:
-                    im.save(location)
-                except OSError as e:
-                    self.error(f"Could not write image to path '{location}'. Reason: {e.strerror}",
-                               level='WARNING')
+                image_executor = ThreadPoolExecutor(1, thread_name_prefix=f'{self.name}_image')
+                self.image_task = image_executor.submit(self.generate_color_map_image, self.color_profile, size,
+                                                        location, color_map_image.get('workers', 1))
+                image_executor.shutdown(wait=False)
             else:
                 self.error("'color_map_image' specified, but 'size' or 'location' not specified in app config. "
                            "Skipping image generation", level='WARNING')
 
-        # register callback
-        media_player = self.args.get('media_player')
-        if not media_player:
-            self.error("'media_player' not specified in app config. Aborting startup", level='ERROR')
-            return
+        # register callbacks, either for a single media player and light or for a list of rooms
+        rooms = self.args.get('rooms')
+        if rooms is None:
+            media_player = self.args.get('media_player')
+            if not media_player:
+                self.error("'media_player' not specified in app config. Aborting startup", level='ERROR')
+                return
+            rooms = [{'media_player': media_player, 'light': self.args.get('light')}]
+
+        prefetch = self.args.get('prefetch', {})
+        self.prefetch_max_tracks = prefetch.get('max_tracks', 500)
+        self.context_attribute = context_attribute = prefetch.get('context_attribute')
+        self.predict_next_track = prefetch.get('next_track', False)
+        self.context_tracks = {}
+        self.predicted_colors = {}
+        if self.predict_next_track and not context_attribute:
+            self.error("'prefetch.next_track' requires 'prefetch.context_attribute'. Next tracks are not predicted",
+                       level='WARNING')
+            self.predict_next_track = False
+        self.schedule_next_track = prefetch.get('schedule_next_track', False)
+        self.track_end_timers = {}
+        self.early_tracks = {}
+        if self.schedule_next_track and not self.predict_next_track:
+            self.error("'prefetch.schedule_next_track' requires 'prefetch.next_track'. Colors are applied on track "
+                       "changes only", level='WARNING')
+            self.schedule_next_track = False
+
+        self.rooms = {}
+        for room in rooms:
+            media_player = room.get('media_player')
+            if not media_player or media_player in self.rooms:
+                self.error(f"Missing or duplicate 'media_player' in room {room}. Skipping room", level='WARNING')
+                continue
+            if 'rooms' in self.args and not room.get('light'):
+                self.error(f"'light' not specified for room of '{media_player}'", level='WARNING')
+
+            mode = room.get('mode', self.args.get('mode', 'direct'))
+            self.rooms[media_player] = Room(media_player, room.get('light'), mode)
+            if mode == 'direct':
+                self.listen_state(self.sync_lights_from_spotify, media_player, attribute='media_content_id')
+                if self.schedule_next_track:
+                    self.listen_state(self.schedule_track_end, media_player, attribute='all')
+            elif mode == 'search':
+                self.listen_state(self.sync_lights_from_search, media_player, attribute='all')
+            else:
+                self.error(f"Unknown mode '{mode}' for '{media_player}'. Must be 'direct' or 'search'",
+                           level='WARNING')
+
+            # prefetch the features of all tracks in the album or playlist that is played
+            if context_attribute:
+                self.listen_state(self.prefetch_from_context, media_player, attribute=context_attribute)
+
+        self.startup_time = time.perf_counter() - start
+        self.log(f"App started in {self.startup_time * 1000:.1f} ms. Listening on {', '.join(self.rooms)}")
 
-        if self.args.get('mode', 'direct') == 'direct':
-            self.listen_state(self.sync_lights_from_spotify, media_player, attribute='media_content_id')
-        elif self.args['mode'] == 'search':
-            self.listen_state(self.sync_lights_from_search, media_player, attribute='all')
-
-        self.log(f"App started. Listening on {media_player}")
-
-    def parse_custom_profile(self) -> ColorProfile:
-        def parse_legacy() -> RGBColorProfile:
-            data = [{'point': x['point'], 'color': x['color'], 'local_weight': 1.0} for x in custom_profile]
-
-            assert len(data) > 0
-            assert all([len(x['point']) == 2 and len(x['color']) == 3 and
-                        0 <= x['point'][0] <= 1 and 0 <= x['point'][1] <= 1 and
-                        0 <= x['color'][0] <= 255 and 0 <= x['color'][1] <= 255 and 0 <= x['color'][2] <= 255
-                        for x in data])
-
-            return RGBColorProfile({
-                'global_weight': 1.0,
-                'sample_data': data
-            })
-
-        def parse_rgb() -> RGBColorProfile:
-            config = {
-                'global_weight': custom_profile.get('global_weight', 1.0),
-                'sample_data': [{
-                    'point': x['point'],
-                    'color': x['color'],
-                    'local_weight': x.get('local_weight', 1.0)
-                } for x in custom_profile['sample_data']]
-            }
-
-            assert len(config['sample_data']) > 0
-            assert all([(isinstance(x['local_weight'], numbers.Number) and
-                         len(x['point']) == 2 and len(x['color']) == 3 and
-                         0 <= x['point'][0] <= 1 and 0 <= x['point'][1] <= 1 and
-                         0 <= x['color'][0] <= 255 and 0 <= x['color'][1] <= 255 and 0 <= x['color'][2] <= 255)
-                        for x in config['sample_data']])
-
-            return RGBColorProfile(config)
-
-        def parse_hs() -> HSColorProfile:
-            config = {
-                'mirror_x': custom_profile.get('mirror_x', False),
-                'mirror_y': custom_profile.get('mirror_y', False),
-                'rotation': custom_profile.get('rotation', 0),
-                'drop_off': custom_profile.get('drop_off', 1),
-            }
-
-            assert isinstance(config['mirror_x'], bool)
-            assert isinstance(config['mirror_y'], bool)
-            assert isinstance(config['rotation'], numbers.Number)
-            assert config['drop_off'] >= 0
-
-            return HSColorProfile(config)
-
-        custom_profile = self.args.get('custom_profile')
+    @property
+    def sp(self) -> 'spotipy.Spotify':
+        """The Spotify client, which is only constructed once the Spotify API is first used."""
+        return shared_spotify_client(self.client_id, self.client_secret)
+
+    def generate_color_map_image(self, color_profile: ColorProfile, size: int, location: str, workers: int) -> None:
+        """Saves an image of the color map, logging failures instead of raising them."""
+        with IMAGE_LOCK:
+            try:
+                try:
+                    up_to_date = not save_color_map_image(color_profile, size, location, workers)
+                except BrokenExecutor as e:
+                    self.error(f"Could not render color map image in worker processes, rendering it in the app "
+                               f"instead. Reason: {e}", level='WARNING')
+                    up_to_date = not save_color_map_image(color_profile, size, location)
+                if up_to_date:
+                    self.log(f"Color map image at '{location}' is up-to-date", level='DEBUG')
+            except OSError as e:
+                self.error(f"Could not write image to path '{location}'. Reason: {e.strerror}", level='WARNING')
+
+    def terminate(self) -> None:
+        """Release the worker pool and caches when the app is stopped or reloaded."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        for cache in (self.feature_cache, self.search_cache, self.feature_dataset):
+            if cache is not None:
+                cache.close()
+
+    def compile_color_profile(self) -> ColorProfile:
+        """Builds the color profile configured for the app, including its lookup table. Profiles are compiled once per
+        configuration and shared by all apps in the process. Configurations with problems, e.g. ones that fall back to
+        the default profile, are not shared, so that the problem is reported on every start."""
+
+        color_profile_arg = self.args.get('color_profile', 'default')
+        custom_profile = self.args.get('custom_profile') if color_profile_arg == 'custom' else None
+        color_lookup_table = self.args.get('color_lookup_table')
         try:
-            if type(custom_profile) is list:  # legacy config, assume RGB values without weights
-                self.error("Using deprecated custom_profile config format. See README for new format.",
-                           level='WARNING')
-                return parse_legacy()
-            elif custom_profile:
-                mode = custom_profile.get('color_mode')
-                if mode == 'rgb':
-                    return parse_rgb()
-                elif mode == 'hs':
-                    return parse_hs()
-                else:
-                    self.error(
-                        f"Unknown color mode '{mode}' in 'custom_profile'. Must be 'rgb' or 'hs'. Falling back to"
-                        f" the default profile", level='WARNING')
-                    return PROFILE_DEFAULT
-            else:
-                self.error("Profile set to 'custom' but no 'custom_profile' specified in app config. Falling back"
-                           " to the default profile", level='WARNING')
-                return PROFILE_DEFAULT
-        except (KeyError, AssertionError):
-            self.error("Profile set to 'custom' but 'custom_profile' is malformed. Falling back to the default"
-                       " profile", level='WARNING')
-            return PROFILE_DEFAULT
+            key = digest(color_profile_arg, custom_profile, color_lookup_table and
+                         {k: v for k, v in color_lookup_table.items() if k != 'report_error'})
+        except TypeError:  # not json serializable
+            key = None
 
-    def sync_lights_from_spotify(self, _entity: str, _attribute: str, old_uri: str, new_uri: str, _kwargs) -> None:
+        with COMPILED_PROFILES_LOCK:
+            if key in COMPILED_PROFILES:
+                return COMPILED_PROFILES[key]
+
+        warnings = []
+
+        def warn(message: str) -> None:
+            warnings.append(message)
+            self.error(message, level='WARNING')
+
+        color_profile = parse_color_profile(self.args, warn)
+        if key is not None and not warnings:
+            with COMPILED_PROFILES_LOCK:
+                COMPILED_PROFILES[key] = color_profile
+        return color_profile
+
+    def sync_lights_from_spotify(self, entity: str, _attribute: str, old_uri: str, new_uri: str, _kwargs) -> None:
+        received = time.perf_counter()
         if new_uri is None or old_uri == new_uri:
             return
 
-        self.sync_light(new_uri)
+        # the color of a correctly predicted track was computed while the previous track was playing, and may have
+        # been applied already when the previous track was predicted to end
+        with self.lock:
+            predicted = self.predicted_colors.pop(entity, None)
+            early = self.early_tracks.pop(entity, None)
+        if early == new_uri:
+            self.log(f"Color of '{new_uri}' on {entity} was applied at the end of the previous track", level='DEBUG')
+        elif predicted is not None and predicted[1] == new_uri:
+            self.count('predicted_tracks')
+            color = predicted[2]
+            self.dispatch(entity, lambda: color, received)
+        else:
+            self.dispatch(entity, partial(self.lookup_color, new_uri), received)
+
+        if self.predict_next_track:
+            if self.executor is None:
+                self.precompute_next_color(entity, new_uri)
+            else:
+                self.executor.submit(self.precompute_next_color, entity, new_uri).add_done_callback(
+                    self.log_lookup_failure)
 
-    def sync_lights_from_search(self, _entity: str, _attribute: str, old: dict, new: dict, _kwargs) -> None:
+    def sync_lights_from_search(self, entity: str, _attribute: str, old: dict, new: dict, _kwargs) -> None:
+        received = time.perf_counter()
         title = new['attributes'].get('media_title')
         artist = new['attributes'].get('media_artist')
         old_title = old['attributes'].get('media_title')
-        old_artist = new['attributes'].get('media_artist')
+        old_artist = old['attributes'].get('media_artist')
 
+        # all attribute changes are received, most of which are not track changes (e.g. position or volume updates)
         if not title or not artist or old_title == title and old_artist == artist:
+            self.count('dropped_events')
             return
 
+        if self.search_debounce <= 0:
+            self.dispatch(entity, partial(self.lookup_color_from_search, title, artist), received)
+            return
+
+        # wait for the track to settle, a burst of track changes is resolved only once
+        with self.lock:
+            pending = self.pending_searches.pop(entity, None)
+            if pending is not None:
+                self.stats['coalesced_events'] += 1
+                self.cancel_timer(pending)
+            self.pending_searches[entity] = self.run_in(self.resolve_pending_search, self.search_debounce,
+                                                        entity=entity, title=title, artist=artist,
+                                                        received=received)
+
+    def schedule_track_end(self, entity: str, _attribute: str, _old: dict, new: dict, _kwargs) -> None:
+        """Schedules the color change to the predicted next track at the end of the current track, as predicted from
+        the playback position of the media player. The schedule is corrected on every state update, e.g. if the
+        position drifts or the user seeks, and cancelled when the playback is paused or stopped."""
+
+        attributes = (new or {}).get('attributes', {})
+        track_uri = attributes.get('media_content_id')
         try:
-            results = self.call_api(partial(self.sp.search, q=f'artist:{artist} track:{title}', type='track'))
-        except ConnectionError as e:
-            self.error(f"Could not reach Spotify API, skipping track. Reason: {e}", level='WARNING')
+            remaining = float(attributes['media_duration']) - float(attributes['media_position'])
+            end = datetime.fromisoformat(str(attributes['media_position_updated_at'])) + timedelta(seconds=remaining)
+        except (KeyError, TypeError, ValueError):
+            end = None
+
+        with self.lock:
+            scheduled = self.track_end_timers.get(entity)
+            if (end is not None and new.get('state') == 'playing' and scheduled is not None and
+                    scheduled[0] == track_uri):
+                deviation = (end - scheduled[1]).total_seconds()
+                # updates that arrive after the track ended, e.g. of the volume, do not schedule the color again
+                if abs(deviation) <= TRACK_END_TOLERANCE or scheduled[2] is None and deviation <= TRACK_END_TOLERANCE:
+                    return
+            self.track_end_timers.pop(entity, None)
+        if scheduled is not None and scheduled[2] is not None:
+            self.cancel_timer(scheduled[2])
+        if end is None or new.get('state') != 'playing' or not track_uri:
             return
 
-        if len(results['tracks']['items']) == 0:
-            self.log(f"Could not find track id for '{title}' by '{artist}'. Searching just by title...",
-                     level='INFO')
+        now = self.datetime(aware=True)
+        if now.tzinfo is None or end.tzinfo is None:  # compare in local time if either time has no timezone
+            now = now.astimezone().replace(tzinfo=None) if now.tzinfo else now
+            end = end.astimezone().replace(tzinfo=None) if end.tzinfo else end
+        delay = max(0.0, (end - now).total_seconds())
+        handle = self.run_in(self.apply_predicted_color, delay, entity=entity, track_uri=track_uri)
+        with self.lock:
+            self.track_end_timers[entity] = (track_uri, end, handle)
+
+    def apply_predicted_color(self, kwargs: dict) -> None:
+        """Applies the precomputed color of the next track when the current track is predicted to end."""
+        entity, track_uri = kwargs['entity'], kwargs['track_uri']
+        with self.lock:
+            # the timer is kept without a handle to mark that the track has ended until the next track starts
+            timer = self.track_end_timers.get(entity)
+            if timer is not None and timer[0] == track_uri:
+                self.track_end_timers[entity] = (timer[0], timer[1], None)
+            predicted = self.predicted_colors.get(entity)
+        # the prediction may have been made for an earlier track, if its lookup finished late
+        if (predicted is None or predicted[0] != track_uri or
+                self.get_state(entity, attribute='media_content_id') != track_uri):
+            return
 
-            try:
-                results = self.call_api(partial(self.sp.search, q=f'track:{title}', type='track'))
-            except ConnectionError as e:
-                self.error(f"Could not reach Spotify API, skipping track. Reason: {e}", level='WARNING')
+        _, next_uri, color = predicted
+        with self.lock:
+            if self.early_tracks.get(entity) == next_uri:
+                return
+            self.early_tracks[entity] = next_uri
+        self.count('early_track_changes')
+        self.log(f"Applying color {color} of next track '{next_uri}' on {entity} at the predicted end of "
+                 f"'{track_uri}'", level='DEBUG')
+        self.apply_color(color, self.rooms[entity].light)
+
+    def resolve_pending_search(self, kwargs: dict) -> None:
+        entity, title, artist = kwargs['entity'], kwargs['title'], kwargs['artist']
+        with self.lock:
+            self.pending_searches.pop(entity, None)
+            if self.resolved_searches.get(entity) == (title, artist):
+                self.stats['dropped_events'] += 1
                 return
+            self.resolved_searches[entity] = (title, artist)
+
+        self.dispatch(entity, partial(self.lookup_color_from_search, title, artist), kwargs['received'])
+
+    def count(self, stat: str) -> None:
+        """Increments an event counter. Counters are incremented from worker threads as well, so this must not be
+        called while holding self.lock."""
+        with self.lock:
+            self.stats[stat] += 1
+
+    def dispatch(self, entity: str, lookup: Callable[[], Optional[RGB_Color]], received: float) -> None:
+        """Runs a color lookup for a track change of a media player and applies the resulting color to the light.
+        The lookup runs on the worker pool if one is configured, otherwise on the calling thread. Lookups that are
+        superseded by a newer track change of the same media player are dropped before they are applied.
+
+        :param received: time.perf_counter() at which the track change was received
+        """
+
+        with self.lock:
+            generation = self.generations[entity] = self.generations.get(entity, 0) + 1
 
-            if len(results['tracks']['items']) == 0:
-                self.error(f"Could not find track id for '{title}'. Skipping track.", level='WARNING')
+        def is_current() -> bool:
+            with self.lock:
+                if self.generations[entity] == generation:
+                    return True
+                self.stats['stale_lookups'] += 1
+                return False
+
+        def run() -> None:
+            self.latency.record('event', time.perf_counter() - received)
+            if not is_current():
+                return
+            color = lookup()
+            if color is None:
                 return
+            if not is_current():
+                self.log(f"Dropping color {color} for {entity}, the track changed during the lookup", level='DEBUG')
+                return
+            self.apply_color(color, self.rooms[entity].light)
+            self.latency.record('total', time.perf_counter() - received)
+
+        if self.executor is None:
+            run()
+        else:
+            self.executor.submit(run).add_done_callback(self.log_lookup_failure)
+
+    def log_lookup_failure(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            self.error(f"Color lookup failed. Reason: {future.exception()!r}", level='ERROR')
+
+    def lookup_color_from_search(self, title: str, artist: str) -> Optional[RGB_Color]:
+        """Get the color for a title and artist, logging failures instead of raising them."""
+        try:
+            with self.latency.measure('search'):
+                track_uri = self.search_track(title, artist)
+        except (CircuitOpenError, *spotify_errors()) as e:
+            return self.failed_lookup_color(e, f"search for '{title}' by '{artist}'")
+
+        if track_uri is None:
+            self.error(f"Could not find track id for '{title}'. Skipping track.", level='WARNING')
+            return None
 
-        track_uri = results['tracks']['items'][0]['uri']
         self.log(f"Found track id '{track_uri}' for '{title}' by '{artist}'", level='DEBUG')
-        self.sync_light(track_uri)
+        return self.lookup_color(track_uri)
 
-    def sync_light(self, track_uri: str) -> None:
+    def search_track(self, title: str, artist: str) -> Optional[str]:
+        """Find the spotify track uri for a title and artist, in the feature dataset if one is configured, otherwise
+        with the Spotify API. Results of the Spotify API are cached, including unsuccessful searches.
+
+        :return: the track uri of the best match, or None if no track was found
+        """
+
+        search = None if self.feature_dataset is not None and not self.dataset_api_fallback else self.request_search
+        track_uri, score = find_track_uri(title, artist, self.search_cache, search, self.search_negative_ttl,
+                                          self.feature_dataset, self.fuzzy_search_index())
+        if score is not None:
+            self.count('fuzzy_matches')
+            self.log(f"Matched '{title}' by '{artist}' to '{track_uri}' with similarity {score:.2f}", level='DEBUG')
+        return track_uri
+
+    def request_search(self, title: str, artist: str) -> dict:
+        """Searches Spotify for a title and artist, sharing the request with concurrent searches for the same track.
+
+        :return: search cache entry holding the uri of the best match, which is None if no track was found
+        """
+        return self.single_flight_call(('search', search_key(title, artist)), partial(
+            request_search, self.call_api, self.sp, title, artist, partial(self.log, level='INFO')))
+
+    def fuzzy_search_index(self) -> Optional[TrackIndex]:
+        """:return: the index of resolved tracks for fuzzy searches, built from the search cache on first use, or None
+        if fuzzy search is disabled"""
+        if self.search_index_args is None:
+            return None
+        with self.lock:
+            if self.search_index is None:
+                index = TrackIndex(**self.search_index_args)
+                for key, entry in self.search_cache.items():
+                    index_cached_search(index, key, entry)
+                self.search_index = index
+            return self.search_index
+
+    def lookup_color(self, track_uri: str) -> Optional[RGB_Color]:
+        """Get the color for a spotify track uri, logging failures instead of raising them."""
         try:
-            color = self.color_from_uri(track_uri)
-        except ConnectionError as e:
-            self.error(f"Could not reach Spotify API, skipping track. Reason: {e}", level='WARNING')
-            return
+            return self.color_from_uri(track_uri)
+        except (CircuitOpenError, *spotify_errors()) as e:
+            return self.failed_lookup_color(e, f"lookup of '{track_uri}'")
         except ValueError as e:
             self.error(f"Could not find features for track uri {track_uri}. This may be caused by trying to use a "
                        f"non-spotify media_player in 'direct' mode. Try using 'search' mode instead.\n"
                        f"Reason: {e}", level='ERROR')
-            return
+        return None
+
+    def log_spotify_failure(self, e: Exception, skipped: str) -> bool:
+        """Logs a failed Spotify API request, only at debug level while the circuit breaker rejects requests.
+
+        :param skipped: what is skipped because of the failure, e.g. "lookup of 'spotify:track:...'"
+        :return: whether the request failed because Spotify is unavailable, as opposed to e.g. client errors
+        """
+        ConnectionError, SpotifyException = spotify_errors()
+        if isinstance(e, CircuitOpenError):
+            self.log(f"Spotify API is unavailable, skipping {skipped}. Reason: {e}", level='DEBUG')
+            return True
+        if isinstance(e, ConnectionError):
+            self.error(f"Could not reach Spotify API, skipping {skipped}. Reason: {e}", level='WARNING')
+            return True
+        self.error(f"Spotify API request failed, skipping {skipped}. Reason: {e}", level='WARNING')
+        return isinstance(e, SpotifyException) and e.http_status >= 500
+
+    def failed_lookup_color(self, e: Exception, skipped: str) -> Optional[RGB_Color]:
+        """Logs a failed Spotify API request for the color of a track.
+
+        :return: the outage color if Spotify is unavailable, None to leave the light unchanged otherwise
+        """
+        return self.outage_color() if self.log_spotify_failure(e, skipped) else None
 
+    def outage_color(self) -> Optional[RGB_Color]:
+        """:return: the color applied instead of the color of a track that could not be looked up because Spotify is
+        unavailable, None to leave the light unchanged"""
+        if self.fallback_color is not None:
+            self.count('fallback_colors')
+        return self.fallback_color
+
+    def apply_color(self, color: RGB_Color, light: Optional[str]) -> None:
         # color is processed even if no light was specified, could be used for debugging
-        if self.light is None:
+        if light is None:
+            return
+
+        # skip colors that are indistinguishable from the current color of the light, to spare the light's network
+        previous = self.last_colors.get(light)
+        if (previous is not None and self.min_color_difference > 0 and self.get_state(light) == 'on' and
+                color_difference(previous, color) < self.min_color_difference):
+            self.count('suppressed_colors')
+            self.log(f"Skipping color {color} for {light}, too similar to the current color {previous}",
+                     level='DEBUG')
             return
 
         # the color mode used here should not matter, since HA already converts it to a mode supported by the light
-        self.turn_on(self.light, **{'rgb_color': color})
+        with self.latency.measure('turn_on'):
+            self.turn_on(light, **{'rgb_color': color})
+        self.last_colors[light] = color
 
     def color_from_uri(self, track_uri: str) -> RGB_Color:
         """Get the color from a spotify track uri."""
 
-        track_features = self.call_api(partial(self.sp.audio_features, track_uri))[0]
-        if not track_features:
-            raise ValueError("no track features found for uri")
-
-        valence: float = track_features['valence']
-        energy: float = track_features['energy']
-        color = self.color_profile.color_for_point((valence, energy))
+        with self.latency.measure('audio_features'):
+            valence, energy = self.features_from_uri(track_uri)
+        with self.latency.measure('color_for_point'):
+            color = self.color_profile.color_for_point((valence, energy))
 
         self.log(f"Got color {color} for valence {valence} and energy {energy} in track '{track_uri}'",
                  level='DEBUG')
 
         return color
 
-    def call_api(self, func: Callable[[], T]) -> T:
-        retries = self.max_retries
-        while True:
+    def publish_latency(self, _kwargs) -> None:
+        """Publishes the latency percentiles of each stage in milliseconds and the event counters as attributes of the
+        latency sensor, whose state is the 95th percentile of the total latency."""
+
+        attributes = {'unit_of_measurement': 'ms', 'friendly_name': f'{self.name} latency'}
+        for stage in LATENCY_STAGES:
+            for q, value in self.latency.percentiles(stage).items():
+                attributes[f'{stage}_p{round(q * 100)}'] = round(value * 1000, 1)
+            attributes[f'{stage}_count'] = self.latency.counts[stage]
+        with self.lock:
+            stats = Counter(dict(self.stats))
+        attributes.update(stats)
+        attributes['circuit_breaker'] = self.circuit_breaker.state
+
+        self.set_state(self.latency_entity, state=attributes.get('total_p95', 'unknown'), attributes=attributes)
+
+        if self.latency_file:
+            # write to a temporary file first, so that scrapers never read a partially written file
             try:
-                return func()
-            except ConnectionError as e:
-                if retries == 0:
-                    raise e
-                else:
-                    self.error(f"Could not reach Spotify API, retrying {retries} more time(s)", level='WARNING')
-                    retries -= 1
+                with open(self.latency_file + '.tmp', 'w') as f:
+                    f.write(self.latency.prometheus_text(self.name, stats))
+                os.replace(self.latency_file + '.tmp', self.latency_file)
+            except OSError as e:
+                self.error(f"Could not write latency metrics to '{self.latency_file}'. Reason: {e}",
+                           level='WARNING')
+
+    def prefetch_from_context(self, entity: str, _attribute: str, old_context: str, new_context: str,
+                              _kwargs) -> None:
+        if not new_context or old_context == new_context:
+            return
+
+        # fetching a long track list must not delay the color of the track that just started
+        if self.executor is None:
+            self.prefetch_context(entity, new_context)
+        else:
+            self.executor.submit(self.prefetch_context, entity, new_context).add_done_callback(self.log_lookup_failure)
+
+    def prefetch_context(self, entity: str, new_context: str) -> None:
+        """Fetches the track list of the album or playlist played by a media player and the features of its tracks,
+        logging failures instead of raising them."""
+        try:
+            track_uris = self.context_track_uris(new_context)
+            with self.lock:
+                self.context_tracks[entity] = track_uris
+            count = self.prefetch_features(track_uris)
+        except (CircuitOpenError, *spotify_errors()) as e:
+            self.log_spotify_failure(e, f"prefetch of context '{new_context}'")
+            return
+
+        self.log(f"Prefetched features of {count} track(s) in context '{new_context}'", level='DEBUG')
+
+    def next_track_uri(self, entity: str, track_uri: str) -> Optional[str]:
+        """Predicts the track following the current track of a media player from the track list of the played album or
+        playlist. The track list is fetched if it is not known yet, e.g. after a restart of the app.
+
+        :return: the uri of the next track, or None if it cannot be predicted, e.g. while shuffling
+        """
+
+        if self.get_state(entity, attribute='shuffle') or self.get_state(entity, attribute='repeat') == 'one':
+            return None
+
+        with self.lock:
+            track_uris = self.context_tracks.get(entity)
+        if track_uris is None:
+            context_uri = self.get_state(entity, attribute=self.context_attribute)
+            if not context_uri:
+                return None
+            track_uris = self.context_track_uris(context_uri)
+            with self.lock:
+                self.context_tracks[entity] = track_uris
+            self.prefetch_features(track_uris)
+
+        if track_uri not in track_uris:
+            return None
+        index = track_uris.index(track_uri) + 1
+        if index < len(track_uris):
+            return track_uris[index]
+        return track_uris[0] if self.get_state(entity, attribute='repeat') == 'all' else None
+
+    def precompute_next_color(self, entity: str, track_uri: str) -> None:
+        """Looks up the color of the track predicted to follow the current track of a media player, so that it is
+        applied without querying Spotify when the track changes."""
+        try:
+            next_uri = self.next_track_uri(entity, track_uri)
+            if next_uri is None:
+                return
+            color = self.color_profile.color_for_point(self.features_from_uri(next_uri))
+        except (CircuitOpenError, *spotify_errors()) as e:
+            self.log_spotify_failure(e, f"prediction of the track following '{track_uri}'")
+            return
+        except ValueError as e:
+            self.error(f"Could not precompute the color of the track following '{track_uri}'. Reason: {e}",
+                       level='WARNING')
+            return
+
+        # the media player may have moved on while the color was looked up on a worker thread
+        if self.get_state(entity, attribute='media_content_id') != track_uri:
+            return
+        with self.lock:
+            self.predicted_colors[entity] = (track_uri, next_uri, color)
+        self.log(f"Predicted color {color} for next track '{next_uri}' on {entity}", level='DEBUG')
+
+    def context_track_uris(self, context_uri: str) -> List[str]:
+        """Get the track uris of a spotify album or playlist uri, up to the configured maximum number of tracks."""
+
+        if context_uri.startswith('spotify:album:'):
+            request = partial(self.sp.album_tracks, context_uri, limit=50)
+
+            def tracks(page: dict) -> List[dict]:
+                return page['items']
+        elif context_uri.startswith('spotify:playlist:'):
+            request = partial(self.sp.playlist_items, context_uri, fields='items(track(uri,is_local)),next',
+                              additional_types=('track',))
+
+            def tracks(page: dict) -> List[dict]:
+                return [item.get('track') for item in page['items']]
+        else:
+            self.log(f"Cannot prefetch context '{context_uri}', only albums and playlists are supported",
+                     level='DEBUG')
+            return []
+
+        track_uris = []
+        page = self.call_api(request)
+        while True:
+            # playlists may contain local files and episodes, which have no audio features
+            track_uris.extend(track['uri'] for track in tracks(page) if track and track.get('uri') and
+                              not track.get('is_local') and not track['uri'].startswith(NO_FEATURES_URI_PREFIXES))
+            if not page.get('next') or len(track_uris) >= self.prefetch_max_tracks:
+                return track_uris[:self.prefetch_max_tracks]
+            page = self.call_api(partial(self.sp.next, page))
+
+    def prefetch_features(self, track_uris: Iterable[str]) -> int:
+        """Fetch the features of multiple tracks into the feature cache with as few requests as possible. Tracks that
+        are already cached are skipped.
+
+        :return: the number of tracks that were not cached before
+        """
+
+        requested = []
+
+        def request(batch: List[str]) -> List[Optional[List[float]]]:
+            requested.extend(batch)
+            return self.request_features(batch)
+
+        find_track_features(track_uris, self.feature_cache, request, self.feature_dataset)
+        return len(requested)
+
+    def features_from_uri(self, track_uri: str) -> Tuple[float, float]:
+        """Get the valence and energy of a spotify track uri. Features in the dataset or cache are used without
+        querying Spotify."""
+
+        request = None if self.feature_dataset is not None and not self.dataset_api_fallback else self.request_features
+        features = find_track_features([track_uri], self.feature_cache, request, self.feature_dataset).get(track_uri)
+        if features is None:
+            raise ValueError("no track features found for uri")
+        return features
+
+    def request_features(self, track_uris: List[str]) -> List[Optional[List[float]]]:
+        """Requests the features of tracks from Spotify, sharing the request with concurrent requests for the same
+        tracks.
+
+        :return: the valence and energy of each track, None for tracks without features
+        """
+        return self.single_flight_call(('audio_features', *track_uris),
+                                       partial(request_audio_features, self.call_api, self.sp, track_uris))
+
+    def single_flight_call(self, key: tuple, func: Callable[[], T]) -> T:
+        """Calls func, unless a call with the same key is already in flight for any app using the same client id, in
+        which case its result is shared."""
+        result, shared = self.single_flight.do(key, func)
+        if shared:
+            self.count('deduplicated_calls')
+        return result
+
+    def call_api(self, func: Callable[[], T]) -> T:
+        """Calls the Spotify API with the retries, rate limit and circuit breaker of the app. See call_spotify."""
+        return call_spotify(func, self.retry, self.rate_limiter, self.circuit_breaker,
+                            partial(self.error, level='WARNING'), self.log, self.count)
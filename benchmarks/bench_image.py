@@ -0,0 +1,22 @@
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import *
+from test_utils import *
+
+SIZES = [64, 128, 256, 512]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_create_color_map_image_rgb(benchmark, size):
+    benchmark(lambda: create_color_map_image(PROFILE_DEFAULT, size), 'create_color_map_image_rgb', items=size * size,
+              repeat=3, size=size)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_create_color_map_image_hs(benchmark, size):
+    benchmark(lambda: create_color_map_image(PROFILE_SATURATED, size), 'create_color_map_image_hs',
+              items=size * size, repeat=3, size=size)
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4])
+def test_create_color_map_image_parallel(benchmark, workers):
+    benchmark(lambda: create_color_map_image(PROFILE_DEFAULT, 2048, workers), 'create_color_map_image_parallel',
+              items=2048 * 2048, repeat=1, size=2048, workers=workers)
@@ -0,0 +1,62 @@
+import time
+from appdaemontestframework import automation_fixture
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync, PersistentCache
+from spotipy import Spotify
+from unittest.mock import patch
+from test_utils import *
+
+EVENTS = 200
+
+
+@automation_fixture(SpotifyMoodLightsSync)
+def uut(given_that):
+    given_that.passed_arg('client_id').is_set_to("_")
+    given_that.passed_arg('client_secret').is_set_to("_")
+    given_that.passed_arg('media_player').is_set_to('media_player.test')
+    given_that.passed_arg('light').is_set_to('light.test_light')
+    given_that.passed_arg('rate_limit').is_set_to(0)
+
+    given_that.state_of('light.test_light').is_set_to('on', attributes={'color': (255, 255, 255)})
+
+
+@pytest.fixture
+def latency(uut, hass_mocks, record_benchmark):
+    """Measures the time from a state event to the turn_on call of the light."""
+    turned_on = []
+    hass_mocks.hass_functions['turn_on'].side_effect = lambda *_args, **_kwargs: turned_on.append(time.perf_counter())
+    NETWORK_STATE.turn_off_errors()
+
+    def measure(event, group: str, cached: bool):
+        timings = []
+        for i in range(EVENTS):
+            if not cached:
+                uut.feature_cache = PersistentCache()
+                uut.search_cache = PersistentCache(table='searches')
+            turned_on.clear()
+            start = time.perf_counter()
+            event(i)
+            timings.append(turned_on[-1] - start)
+        record_benchmark(timings, group, cached=cached)
+
+    return measure
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@patch.object(Spotify, 'audio_features', new=mock_audio_features)
+def test_direct_mode(uut, latency, cached):
+    tracks = list(TRACKS.keys())
+    latency(lambda i: uut.sync_lights_from_spotify('media_player.test', 'media_content_id', tracks[i % len(tracks)],
+                                                   tracks[(i + 1) % len(tracks)], None),
+            'sync_lights_from_spotify', cached)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@patch.object(Spotify, 'audio_features', new=mock_audio_features)
+@patch.object(Spotify, 'search', new=mock_search)
+def test_search_mode(uut, latency, cached):
+    uut.args['mode'] = 'search'
+    uut.initialize()
+    songs = [{'attributes': {'media_title': title, 'media_artist': artist}} for title, artist in SONGS]
+    latency(lambda i: uut.sync_lights_from_search('media_player.test', None, songs[i % len(songs)],
+                                                  songs[(i + 1) % len(songs)], None),
+            'sync_lights_from_search', cached)
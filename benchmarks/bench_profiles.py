@@ -0,0 +1,64 @@
+import numpy as np
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import *
+from test_utils import *
+
+SAMPLE_COUNTS = [7, 50, 250, 1000]
+POINTS = np.random.default_rng(0).random((1000, 2))
+
+
+def random_profile(samples: int, **config) -> RGBColorProfile:
+    rng = np.random.default_rng(samples)
+    return RGBColorProfile({
+        'global_weight': 2,
+        **config,
+        'sample_data': [{
+            'point': tuple(rng.random(2)),
+            'color': tuple(int(c) for c in rng.integers(0, 256, 3)),
+            'local_weight': float(rng.uniform(0.5, 2)),
+        } for _ in range(samples)]
+    })
+
+
+def evaluate(profile: ColorProfile):
+    return lambda: [profile.color_for_point((x, y)) for x, y in POINTS.tolist()]
+
+
+@pytest.mark.parametrize('samples', SAMPLE_COUNTS)
+def test_rgb_color_for_point(benchmark, samples):
+    benchmark(evaluate(random_profile(samples)), 'rgb_color_for_point', items=len(POINTS), samples=samples)
+
+
+@pytest.mark.parametrize('samples', SAMPLE_COUNTS)
+def test_rgb_color_for_points(benchmark, samples):
+    profile = random_profile(samples)
+    benchmark(lambda: profile.color_for_points(POINTS), 'rgb_color_for_points', items=len(POINTS), samples=samples)
+
+
+@pytest.mark.parametrize('samples', SAMPLE_COUNTS)
+@pytest.mark.parametrize('config', [{'neighbors': 16}, {'cutoff': 1E-3, 'global_weight': 8}])
+def test_rgb_neighborhood_color_for_point(benchmark, samples, config):
+    benchmark(evaluate(random_profile(samples, **config)), 'rgb_neighborhood_color_for_point', items=len(POINTS),
+              samples=samples, **config)
+
+
+@pytest.mark.parametrize('samples', SAMPLE_COUNTS)
+@pytest.mark.parametrize('config', [{'neighbors': 16}, {'cutoff': 1E-3, 'global_weight': 8}])
+def test_rgb_neighborhood_color_for_points(benchmark, samples, config):
+    profile = random_profile(samples, **config)
+    benchmark(lambda: profile.color_for_points(POINTS), 'rgb_neighborhood_color_for_points', items=len(POINTS),
+              samples=samples, **config)
+
+
+def test_hs_color_for_point(benchmark):
+    benchmark(evaluate(HSColorProfile(CUSTOM_PROFILE_HS)), 'hs_color_for_point', items=len(POINTS))
+
+
+def test_hs_color_for_points(benchmark):
+    profile = HSColorProfile(CUSTOM_PROFILE_HS)
+    benchmark(lambda: profile.color_for_points(POINTS), 'hs_color_for_points', items=len(POINTS))
+
+
+@pytest.mark.parametrize('samples', SAMPLE_COUNTS)
+def test_lut_color_for_point(benchmark, samples):
+    benchmark(evaluate(LUTColorProfile(random_profile(samples))), 'lut_color_for_point', items=len(POINTS),
+              samples=samples)
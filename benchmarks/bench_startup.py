@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+from appdaemontestframework import automation_fixture
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync
+from test_utils import *
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+# appdaemon is already loaded when apps are imported, so it is excluded from the measured import time
+IMPORT_SCRIPT = """
+import time
+import appdaemon.plugins.hass.hassapi
+start = time.perf_counter()
+import apps.spotify_mood_lights_sync.spotify_mood_lights_sync
+print(time.perf_counter() - start)
+"""
+
+
+@automation_fixture(SpotifyMoodLightsSync)
+def uut(given_that):
+    given_that.passed_arg('client_id').is_set_to("_")
+    given_that.passed_arg('client_secret').is_set_to("_")
+    given_that.passed_arg('media_player').is_set_to('media_player.test')
+    given_that.passed_arg('light').is_set_to('light.test_light')
+
+
+def test_import(record_benchmark):
+    timings = [float(subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, check=True, capture_output=True,
+                                    text=True).stdout) for _ in range(5)]
+    record_benchmark(timings, 'import')
+
+
+@pytest.mark.parametrize('image', [False, True])
+def test_initialize(uut, given_that, benchmark, tmp_path, image):
+    if image:
+        given_that.passed_arg('color_map_image').is_set_to({'size': 200, 'location': str(tmp_path / 'out.png')})
+        given_that.passed_arg('color_profile').is_set_to('saturated')
+
+    benchmark(uut.initialize, 'initialize', image=image)
+    if uut.image_task is not None:
+        uut.image_task.result()
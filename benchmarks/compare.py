@@ -0,0 +1,30 @@
+"""Compares two benchmark result files.
+
+usage: python benchmarks/compare.py baseline.json results.json
+"""
+
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return {(b['name'], b['group']): b for b in json.load(f)['benchmarks']}
+
+
+def main(baseline_path: str, results_path: str):
+    baseline = load(baseline_path)
+    results = load(results_path)
+
+    print(f"{'benchmark':<60} {'baseline':>12} {'result':>12} {'speedup':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]['median'], result['median']
+        print(f"{key[0]:<60} {before * 1000:>10.3f}ms {after * 1000:>10.3f}ms {before / after:>7.2f}x")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    main(sys.argv[1], sys.argv[2])
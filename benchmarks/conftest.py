@@ -0,0 +1,95 @@
+"""Benchmarks for the color profiles, color map image generation and the latency of the state callbacks.
+
+The benchmarks are not part of the test suite. Run them from the repository root with:
+
+    python -m pytest benchmarks -o python_files='bench_*.py' --benchmark-output=results.json
+
+Results are written as json, two runs can be compared with:
+
+    python benchmarks/compare.py baseline.json results.json
+"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, List
+
+import pytest
+
+# the benchmarks reuse the mocked spotify api of the tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'tests'))
+
+RESULTS: List[dict] = []
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark-output', default='benchmark_results.json',
+                     help="path of the json file to which the benchmark results are written")
+
+
+@pytest.fixture
+def record_benchmark(request):
+    def record(timings: List[float], group: str, items: int = 1, **params) -> dict:
+        """Records timings of a benchmark.
+
+        :param timings: measured durations in seconds
+        :param group: name under which results of the same benchmark with different parameters are grouped
+        :param items: number of items processed in each sample, e.g. points evaluated
+        :param params: parameters of the benchmark
+        """
+        result = {
+            'name': request.node.name,
+            'group': group,
+            'params': params,
+            'items': items,
+            'runs': len(timings),
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.fmean(timings),
+            'max': max(timings),
+            'items_per_second': items / statistics.median(timings),
+        }
+        RESULTS.append(result)
+        return result
+
+    return record
+
+
+@pytest.fixture
+def benchmark(record_benchmark):
+    def run(func: Callable[[], None], group: str, items: int = 1, repeat: int = 5, **params) -> dict:
+        """Times repeated calls of a function after one warm-up call."""
+        func()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return record_benchmark(timings, group, items, **params)
+
+    return run
+
+
+def pytest_sessionfinish(session):
+    if not RESULTS:
+        return
+
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    with open(session.config.getoption('--benchmark-output', default='benchmark_results.json'), 'w') as f:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': numpy_version,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'benchmarks': RESULTS,
+        }, f, indent=2)
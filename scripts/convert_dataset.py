@@ -0,0 +1,54 @@
+"""Converts a CSV export of Spotify track features, e.g. one of the public Kaggle datasets, into a feature dataset file
+for the `feature_dataset` option.
+
+usage: python scripts/convert_dataset.py tracks.csv /config/appdaemon/features.bin
+"""
+
+import argparse
+import ast
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'apps'))
+from spotify_mood_lights_sync.spotify_mood_lights_sync import write_feature_dataset  # noqa: E402
+
+
+def parse_artists(value: str, separator: str) -> list:
+    # some exports store the artists as a python list literal, e.g. "['Artist A', 'Artist B']"
+    if value.startswith('['):
+        try:
+            return [str(artist) for artist in ast.literal_eval(value)]
+        except (ValueError, SyntaxError):
+            pass
+    return [artist.strip() for artist in value.split(separator) if artist.strip()]
+
+
+def read_tracks(path: str, args: argparse.Namespace):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            try:
+                track_id = row[args.id_column].rsplit(':', 1)[-1]
+                if len(track_id) != 22 or not (track_id.isascii() and track_id.isalnum()):
+                    raise ValueError(f"invalid track id '{track_id}'")
+                yield (track_id, row[args.title_column],
+                       parse_artists(row[args.artist_column], args.artist_separator),
+                       float(row[args.valence_column]), float(row[args.energy_column]))
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                print(f"Skipping malformed row {row!r}: {e!r}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('csv', help="path of the CSV file")
+    parser.add_argument('output', help="path of the dataset file to write")
+    parser.add_argument('--id-column', default='id')
+    parser.add_argument('--title-column', default='name')
+    parser.add_argument('--artist-column', default='artists')
+    parser.add_argument('--artist-separator', default=';')
+    parser.add_argument('--valence-column', default='valence')
+    parser.add_argument('--energy-column', default='energy')
+    args = parser.parse_args()
+
+    count = write_feature_dataset(read_tracks(args.csv, args), args.output)
+    print(f"Wrote features of {count} tracks to '{args.output}'")
@@ -0,0 +1,288 @@
+"""Maps a list of tracks to the colors of a color profile, e.g. to warm the caches of the app for a whole catalog or to
+audit a color profile. Tracks are read and written as a stream in batches, so the list may be arbitrarily large.
+
+Each input line holds either a Spotify track uri, id or link, or a title and artist separated by a tab. CSV and JSONL
+input must provide a 'uri' or a 'title' and 'artist' per track.
+
+usage: python scripts/map_tracks.py tracks.txt colors.csv --config /config/appdaemon/apps/apps.yaml --app mood_lights
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'apps'))
+from spotify_mood_lights_sync.spotify_mood_lights_sync import (  # noqa: E402
+    CircuitBreaker, CircuitOpenError, ColorProfile, FeatureDataset, PersistentCache, RetryPolicy, SingleFlight,
+    TokenBucket, call_spotify, find_track_features, find_track_uri, parse_color_profile, request_audio_features,
+    request_search, search_key, shared_spotify_client, spotify_errors)
+
+T = TypeVar('T')
+
+FIELDS = ('uri', 'title', 'artist', 'valence', 'energy', 'red', 'green', 'blue')
+
+
+def warn(message: str) -> None:
+    print(message, file=sys.stderr)
+
+
+def track_uri(value: str) -> Optional[str]:
+    """:return: the 'spotify:track:<id>' uri of a track uri, id or link, or None if the value is not one of these"""
+    value = value.strip()
+    if value.startswith('https://open.spotify.com/track/'):
+        value = value.split('?', 1)[0].rsplit('/', 1)[-1]
+    elif value.startswith('spotify:track:'):
+        value = value[len('spotify:track:'):]
+    if len(value) == 22 and value.isascii() and value.isalnum():
+        return 'spotify:track:' + value
+    return None
+
+
+def read_tracks(lines: Iterable[str], input_format: str) -> Iterator[dict]:
+    """Parses the input lazily into dicts holding either the 'uri' or the 'title' and 'artist' of each track."""
+    if input_format == 'csv':
+        rows = csv.DictReader(lines)
+    elif input_format == 'jsonl':
+        rows = (json.loads(line) for line in lines if line.strip())
+    else:
+        rows = ({'uri': line} if track_uri(line) else dict(zip(('title', 'artist'), line.rstrip('\r\n').split('\t', 1)))
+                for line in lines if line.strip())
+
+    for row in rows:
+        uri = track_uri(row.get('uri') or '')
+        if uri is not None:
+            yield {'uri': uri}
+        elif row.get('title'):
+            yield {'title': row['title'].strip(), 'artist': (row.get('artist') or '').strip()}
+        else:
+            warn(f"Skipping malformed track {row!r}")
+
+
+class TrackMapper:
+    """Resolves batches of tracks to their features and colors, using the feature dataset and caches of the app before
+    querying Spotify like the app does."""
+
+    def __init__(self, color_profile: ColorProfile, feature_cache: PersistentCache, search_cache: PersistentCache,
+                 sp=None, rate_limiter: Optional[TokenBucket] = None, feature_dataset: Optional[FeatureDataset] = None,
+                 api_fallback: bool = True, search_negative_ttl: float = 24 * 3600, retry: RetryPolicy = RetryPolicy(),
+                 circuit_breaker: Optional[CircuitBreaker] = None, search_threads: int = 4):
+        """
+        :param sp: spotify client, tracks missing from the dataset and caches are not resolved if None
+        :param search_threads: number of concurrent searches, as Spotify has no endpoint to search multiple tracks
+        """
+        self.color_profile = color_profile
+        self.feature_cache = feature_cache
+        self.search_cache = search_cache
+        self.sp = sp
+        self.rate_limiter = rate_limiter or TokenBucket(0, 1)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(5, 60)
+        self.single_flight = SingleFlight()
+        self.feature_dataset = feature_dataset
+        self.api_fallback = api_fallback and sp is not None
+        self.search_negative_ttl = search_negative_ttl
+        self.retry = retry
+        self.executor = ThreadPoolExecutor(max(1, search_threads), thread_name_prefix='search')
+
+    def call_api(self, func: Callable[[], T]) -> T:
+        """Calls the Spotify API with the same retries, rate limit and circuit breaker as the app."""
+        return call_spotify(func, self.retry, self.rate_limiter, self.circuit_breaker, warn, warn, lambda event: None)
+
+    def search(self, title: str, artist: str) -> Optional[str]:
+        """Finds the track uri for a title and artist like the search mode of the app, sharing its search cache."""
+        return find_track_uri(title, artist, self.search_cache, self.request_search if self.api_fallback else None,
+                              self.search_negative_ttl, self.feature_dataset)[0]
+
+    def request_search(self, title: str, artist: str) -> dict:
+        # the same title and artist may be searched concurrently within a batch
+        return self.single_flight.do(('search', search_key(title, artist)), partial(
+            request_search, self.call_api, self.sp, title, artist, lambda message: None))[0]
+
+    def try_search(self, track: dict) -> Optional[str]:
+        try:
+            return self.search(track['title'], track['artist'])
+        except (CircuitOpenError, *spotify_errors()) as e:
+            warn(f"Could not search for '{track['title']}' by '{track['artist']}'. Reason: {e}")
+            return None
+
+    def request_features(self, track_uris: List[str]) -> List[Optional[List[float]]]:
+        try:
+            return request_audio_features(self.call_api, self.sp, track_uris)
+        except (CircuitOpenError, *spotify_errors()) as e:
+            warn(f"Could not get features of {len(track_uris)} track(s). Reason: {e}")
+            return [None] * len(track_uris)
+
+    def features(self, uris: Iterable[str]) -> Dict[str, Tuple[float, float]]:
+        """Gets the valence and energy of multiple tracks, requesting missing ones from Spotify in batches.
+
+        :return: features by track uri, tracks without features are left out
+        """
+        return find_track_features(uris, self.feature_cache, self.request_features if self.api_fallback else None,
+                                   self.feature_dataset)
+
+    def map_batch(self, tracks: List[dict]) -> List[dict]:
+        """Resolves a batch of tracks read by read_tracks into rows holding all FIELDS, which are None for tracks that
+        could not be resolved."""
+        searches = [track for track in tracks if 'uri' not in track]
+        for track, uri in zip(searches, self.executor.map(self.try_search, searches)):
+            track['uri'] = uri
+
+        features = self.features(track['uri'] for track in tracks if track['uri'])
+        resolved = [track for track in tracks if track['uri'] in features]
+        colors = self.color_profile.color_for_points([features[track['uri']] for track in resolved]) if resolved else []
+        for track, color in zip(resolved, colors):
+            track['valence'], track['energy'] = features[track['uri']]
+            track['red'], track['green'], track['blue'] = (int(c) for c in color)
+
+        for track in tracks:
+            if track['uri'] not in features:
+                warn(f"Could not resolve track {track.get('uri') or (track['title'], track['artist'])}")
+        return [{field: track.get(field) for field in FIELDS} for track in tracks]
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+def batches(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_rows(rows: Iterable[dict], output, output_format: str) -> None:
+    if output_format == 'csv':
+        writer = csv.DictWriter(output, FIELDS, lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(row: dict) -> None:
+            output.write(json.dumps(row) + '\n')
+
+    for row in rows:
+        write(row)
+
+
+def map_tracks(mapper: TrackMapper, lines: Iterable[str], output, input_format: str = 'text',
+               output_format: str = 'csv', batch_size: int = 1000) -> None:
+    """Streams the tracks of the input lines to rows of the output, holding at most one batch of tracks in memory."""
+    rows = (row for batch in batches(read_tracks(lines, input_format), batch_size) for row in mapper.map_batch(batch))
+    write_rows(rows, output, output_format)
+
+
+def find_secrets(path: str) -> Optional[str]:
+    """:return: the path of the secrets.yaml next to a config file or in a parent directory, like the AppDaemon config
+    directory above the apps directory, or None if there is none"""
+    directory = os.path.dirname(os.path.abspath(path))
+    while True:
+        secrets = os.path.join(directory, 'secrets.yaml')
+        if os.path.isfile(secrets):
+            return secrets
+        if os.path.dirname(directory) == directory:
+            return None
+        directory = os.path.dirname(directory)
+
+
+def load_app_config(path: str, app: Optional[str]) -> dict:
+    """Loads the args of an app from an apps.yaml, resolving '!secret' tags from the secrets.yaml found by
+    find_secrets."""
+    import yaml
+
+    secrets = None
+
+    def secret(loader: yaml.SafeLoader, node: yaml.Node):
+        nonlocal secrets
+        name = loader.construct_scalar(node)
+        if secrets is None:
+            secrets_path = find_secrets(path)
+            if secrets_path is None:
+                raise SystemExit(f"Found '!secret {name}' in '{path}', but no secrets.yaml next to it")
+            with open(secrets_path, encoding='utf-8') as f:
+                secrets = yaml.safe_load(f) or {}
+        if name not in secrets:
+            raise SystemExit(f"Secret '{name}' not found in secrets.yaml")
+        return secrets[name]
+
+    class Loader(yaml.SafeLoader):
+        pass
+
+    Loader.add_constructor('!secret', secret)
+    with open(path, encoding='utf-8') as f:
+        config = yaml.load(f, Loader=Loader) or {}
+    if app is None:
+        apps = [name for name, args in config.items() if isinstance(args, dict) and
+                args.get('class') == 'SpotifyMoodLightsSync']
+        if len(apps) != 1:
+            raise SystemExit(f"Found {len(apps)} SpotifyMoodLightsSync apps in '{path}', select one with --app")
+        app = apps[0]
+    if app not in config:
+        raise SystemExit(f"App '{app}' not found in '{path}'")
+    return config[app]
+
+
+def open_cache(config: dict, table: str) -> PersistentCache:
+    return PersistentCache(config.get('location', ':memory:'), config.get('max_size', 10000),
+                           config.get('ttl', 30 * 24 * 3600), table=table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="path of the track list, '-' for stdin")
+    parser.add_argument('output', nargs='?', default='-', help="path of the output file, stdout by default")
+    parser.add_argument('--input-format', choices=('text', 'csv', 'jsonl'), default='text')
+    parser.add_argument('--output-format', choices=('csv', 'jsonl'))
+    parser.add_argument('--config', help="apps.yaml holding the app config, whose profile, dataset and caches are used")
+    parser.add_argument('--app', help="name of the app in the config, required if it holds multiple apps")
+    parser.add_argument('--profile', help="color profile overriding the 'color_profile' of the app config")
+    parser.add_argument('--client-id', help="Spotify client id, taken from the app config by default")
+    parser.add_argument('--client-secret', help="Spotify client secret, taken from the app config by default")
+    parser.add_argument('--offline', action='store_true', help="only use the feature dataset and caches")
+    parser.add_argument('--batch-size', type=int, default=1000, help="number of tracks mapped at once")
+    parser.add_argument('--search-threads', type=int, default=4, help="number of concurrent searches")
+    args = parser.parse_args()
+
+    app_args = load_app_config(args.config, args.app) if args.config else {}
+    if args.profile:
+        app_args['color_profile'] = args.profile
+    client_id = args.client_id or app_args.get('client_id')
+    client_secret = args.client_secret or app_args.get('client_secret')
+    if not args.offline and not (client_id and client_secret):
+        parser.error("Spotify client id and secret are required unless --offline is set")
+
+    feature_cache_args = app_args.get('feature_cache', {})
+    search_cache_args = app_args.get('search_cache', {})
+    feature_dataset = app_args.get('feature_dataset', {})
+    circuit_breaker = app_args.get('circuit_breaker', {})
+    mapper = TrackMapper(
+        parse_color_profile(app_args, warn),
+        open_cache(feature_cache_args, 'cache'),
+        open_cache(search_cache_args, 'searches'),
+        sp=None if args.offline else shared_spotify_client(client_id, client_secret),
+        rate_limiter=TokenBucket(app_args.get('rate_limit', 10), app_args.get('rate_limit_burst', 20)),
+        circuit_breaker=CircuitBreaker(circuit_breaker.get('failure_threshold', 5),
+                                       circuit_breaker.get('reset_timeout', 60)),
+        feature_dataset=FeatureDataset(feature_dataset['location']) if feature_dataset.get('location') else None,
+        api_fallback=feature_dataset.get('api_fallback', True),
+        search_negative_ttl=search_cache_args.get('negative_ttl', 24 * 3600),
+        retry=RetryPolicy(app_args.get('max_retries', 1), app_args.get('retry_base_delay', 0.5),
+                          app_args.get('retry_max_delay', 30)),
+        search_threads=args.search_threads)
+
+    output_format = args.output_format or ('jsonl' if args.output.endswith('.jsonl') else 'csv')
+    source = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    target = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        map_tracks(mapper, source, target, args.input_format, output_format, args.batch_size)
+    finally:
+        mapper.close()
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
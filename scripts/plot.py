@@ -1,15 +1,23 @@
+import argparse
 from spotify_mood_lights_sync.spotify_mood_lights_sync import *
 import matplotlib.pyplot as plt
 
-def generate_subplot(profile: ColorProfile, size: int, title: str, axis) -> None:
-    axis.imshow(create_color_map_image(profile, size), extent=(0, 1, 0, 1))
+def generate_subplot(profile: ColorProfile, size: int, workers: int, title: str, axis) -> None:
+    axis.imshow(create_color_map_image(profile, size, workers), extent=(0, 1, 0, 1))
     axis.set_xlabel('positivity')
     axis.set_ylabel('energy')
     axis.set_title(title)
 
 
-fig, (ax1, ax2) = plt.subplots(1, 2)
-generate_subplot(PROFILE_DEFAULT, 250, 'Default Profile', ax1)
-generate_subplot(PROFILE_SATURATED, 250, 'Saturated Profile', ax2)
-fig.tight_layout()
-fig.savefig('profiles.png', bbox_inches='tight')
+# the main guard is required, as worker processes import this script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plots the default and saturated color profiles to profiles.png")
+    parser.add_argument('--size', type=int, default=250, help="height and width of each color map in pixels")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes rendering each color map")
+    args = parser.parse_args()
+
+    fig, (ax1, ax2) = plt.subplots(1, 2)
+    generate_subplot(PROFILE_DEFAULT, args.size, args.workers, 'Default Profile', ax1)
+    generate_subplot(PROFILE_SATURATED, args.size, args.workers, 'Saturated Profile', ax2)
+    fig.tight_layout()
+    fig.savefig('profiles.png', bbox_inches='tight')
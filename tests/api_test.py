@@ -0,0 +1,146 @@
+import threading
+
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import (
+    CircuitBreaker, SingleFlight, TokenBucket, shared_circuit_breaker, shared_rate_limiter, shared_single_flight)
+from test_utils import *
+
+
+class TestTokenBucket:
+    def test_burst(self, fake_clock):
+        bucket = TokenBucket(1, 3)
+        assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+        assert fake_clock.sleeps == []
+
+    def test_throttle(self, fake_clock):
+        bucket = TokenBucket(2, 1)
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0.5
+        fake_clock.sleep(2)
+        assert bucket.acquire() == 0
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0, 1)
+        assert all(bucket.acquire() == 0 for _ in range(100))
+
+    def test_pause(self, fake_clock):
+        bucket = TokenBucket(0, 1)
+        bucket.pause(3)
+        assert bucket.acquire() == 3
+
+    def test_shared(self):
+        assert shared_rate_limiter('a', 5, 10) is shared_rate_limiter('a', 5, 10)
+        assert shared_rate_limiter('a', 5, 10) is not shared_rate_limiter('b', 5, 10)
+
+    def test_shared_keeps_first_settings(self):
+        bucket = shared_rate_limiter('a', 5, 10)
+        assert shared_rate_limiter('a', 1, 2) is bucket
+        assert (bucket.rate, bucket.capacity) == (5, 10)
+
+
+class TestCircuitBreaker:
+    def test_open(self, fake_clock):
+        breaker = CircuitBreaker(3, 10)
+        assert [breaker.record_failure() for _ in range(3)] == [False, False, True]
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        fake_clock.sleep(9)
+        assert not breaker.allow()
+
+    def test_half_open(self, fake_clock):
+        breaker = CircuitBreaker(1, 10)
+        breaker.record_failure()
+        fake_clock.sleep(10)
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()  # only a single trial call
+
+        assert breaker.record_failure()
+        assert not breaker.allow()
+        fake_clock.sleep(10)
+        assert breaker.allow()
+        assert breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow() and breaker.allow()
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(2, 10)
+        breaker.record_failure()
+        assert not breaker.record_success()
+        assert not breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(0, 10)
+        assert not any(breaker.record_failure() for _ in range(100))
+        assert breaker.allow()
+
+    def test_shared(self):
+        assert shared_circuit_breaker('a', 5, 60) is shared_circuit_breaker('a', 5, 60)
+        assert shared_circuit_breaker('a', 5, 60) is not shared_circuit_breaker('b', 5, 60)
+
+    def test_shared_keeps_first_settings(self):
+        breaker = shared_circuit_breaker('a', 5, 60)
+        assert shared_circuit_breaker('a', 3, 10) is breaker
+        assert (breaker.failure_threshold, breaker.reset_timeout) == (5, 60)
+
+
+class TestSingleFlight:
+    @staticmethod
+    def concurrent(flight, func, followers=2):
+        started = threading.Event()
+        release = threading.Event()
+
+        def leader():
+            started.set()
+            release.wait(5)
+            return func()
+
+        results = []
+
+        def call(f):
+            try:
+                results.append(flight.do('key', f))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call, args=(leader,))]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=call, args=(func,)) for _ in range(followers)]
+        for thread in threads[1:]:
+            thread.start()
+        while flight.shared < followers:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_shared_result(self):
+        flight = SingleFlight()
+        calls = []
+        results = self.concurrent(flight, lambda: calls.append(1) or 'result')
+
+        assert len(calls) == 1
+        assert sorted(results) == [('result', False), ('result', True), ('result', True)]
+        assert flight.calls == {}
+
+    def test_shared_exception(self):
+        flight = SingleFlight()
+        error = ValueError('not found')
+
+        def fail():
+            raise error
+
+        assert self.concurrent(flight, fail) == [error] * 3
+        assert flight.do('key', lambda: 1) == (1, False)
+
+    def test_sequential_calls(self):
+        flight = SingleFlight()
+        assert flight.do('a', lambda: 1) == (1, False)
+        assert flight.do('a', lambda: 2) == (2, False)
+        assert flight.shared == 0
+
+    def test_shared(self):
+        assert shared_single_flight('a') is shared_single_flight('a')
+        assert shared_single_flight('a') is not shared_single_flight('b')
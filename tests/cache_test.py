@@ -0,0 +1,107 @@
+from unittest.mock import patch
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import PersistentCache, TrackIndex, normalize_track_text
+from test_utils import *
+
+
+class TestPersistentCache:
+    def test_get_put(self):
+        cache = PersistentCache()
+        assert cache.get('a') is None
+        assert cache.get('a', 'default') == 'default'
+
+        cache.put('a', [0.5, 0.25])
+        assert cache.get('a') == [0.5, 0.25]
+        assert len(cache) == 1
+
+    def test_expiry(self):
+        cache = PersistentCache(ttl=10)
+        with patch('time.time', return_value=1000):
+            cache.put('a', 1)
+            cache.put('b', 2, ttl=100)
+        with patch('time.time', return_value=1050):
+            assert cache.get('a') is None
+            assert cache.get('b') == 2
+
+    def test_lru_eviction(self):
+        cache = PersistentCache(max_size=2)
+        with patch('time.time', return_value=1):
+            cache.put('a', 1)
+        with patch('time.time', return_value=2):
+            cache.put('b', 2)
+        with patch('time.time', return_value=3):
+            cache.get('a')
+        with patch('time.time', return_value=4):
+            cache.put('c', 3)
+
+            assert len(cache) == 2
+            assert cache.get('a') == 1
+            assert cache.get('b') is None
+            assert cache.get('c') == 3
+
+    def test_persistence(self, tmp_path):
+        cache = PersistentCache(str(tmp_path / 'cache.db'))
+        cache.put('a', 1)
+        cache.close()
+
+        assert PersistentCache(str(tmp_path / 'cache.db')).get('a') == 1
+
+    def test_items(self):
+        cache = PersistentCache()
+        cache.put('a', {'uri': 'x'})
+        cache.put('b', 1, ttl=-1)
+        assert cache.items() == [('a', {'uri': 'x'})]
+
+
+class TestTrackIndex:
+    @pytest.mark.parametrize('text, expected', [
+        ("Don't Stop Me Now - Remastered 2011", 'dont stop me now'),
+        ('Crazy In Love (feat. Jay-Z)', 'crazy in love'),
+        ('Song ft. Someone', 'song'),
+        ('Hello [Radio Edit]', 'hello'),
+        ('Dancing With Myself', 'dancing with myself'),
+        ('Beyoncé', 'beyonce'),
+        ('Mr. Brightside', 'mr brightside'),
+    ])
+    def test_normalize(self, text, expected):
+        assert normalize_track_text(text) == expected
+
+    def test_match(self):
+        index = TrackIndex()
+        index.add("Don't Stop Me Now - Remastered 2011", 'Queen', 'a')
+        index.add('Crazy In Love', 'Beyoncé, Jay-Z', 'b')
+
+        assert index.match("Don't Stop Me Now (2011 Remaster)", 'QUEEN') == ('a', 1.0)
+        assert index.match('Dont Stop Me Now', 'Queen.') == ('a', 1.0)
+        assert index.match('Crazy in Love (feat. JAY Z)', 'Beyonce feat. Jay Z')[0] == 'b'
+        assert index.match('Crazy in Love', 'Jay-Z')[0] == 'b'
+        assert index.match("Don't Stop Me Now", 'Other Artist') is None
+        assert index.match('Stop', 'Queen') is None
+        assert index.match('', 'Queen') is None
+
+    def test_similar_titles(self):
+        index = TrackIndex(min_similarity=0.85)
+        index.add('song 1', 'artist 1', 'a')
+        assert index.match('song 2', 'artist 1') is None
+        assert index.match('Bohemian Rhapsodey', 'Queen') is None
+        index.add('Bohemian Rhapsody', 'Queen', 'c')
+        uri, score = index.match('Bohemian Rhapsodey', 'Queen')
+        assert uri == 'c' and 0.85 <= score < 1
+
+    def test_numbered_titles(self):
+        index = TrackIndex()
+        index.add('Another Brick in the Wall, Pt. 1', 'Pink Floyd', 'a')
+        index.add('Symphony Part II', 'Artist', 'b')
+        assert index.match('Another Brick in the Wall, Pt. 2', 'Pink Floyd') is None
+        assert index.match('Another Brick in the Wall Pt 01', 'Pink Floyd')[0] == 'a'
+        assert index.match('Symphony Part III', 'Artist') is None
+        assert index.match('Symphony Part 2', 'Artist') is None
+        assert index.match('Symphony - Part II', 'Artist') == ('b', 1.0)
+
+    def test_max_size(self):
+        index = TrackIndex(max_size=2)
+        for i, title in enumerate(['first song', 'second song', 'third song']):
+            index.add(title, 'artist', str(i))
+        assert len(index) == 2
+        assert index.match('first song', 'artist') is None
+        assert index.match('third song', 'artist') == ('2', 1.0)
+        assert all(key in index.entries for keys in index.postings.values() for key in keys)
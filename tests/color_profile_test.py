@@ -0,0 +1,136 @@
+import numpy as np
+from unittest.mock import patch
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import *
+from test_utils import *
+
+
+@pytest.fixture
+def points():
+    grid = np.stack(np.meshgrid(np.linspace(0, 1, 51), np.linspace(0, 1, 51)), axis=-1).reshape(-1, 2)
+    return np.concatenate([grid, np.random.default_rng(0).random((2000, 2))])
+
+
+def scalar_colors(profile, points):
+    return np.array([profile.color_for_point((p[0], p[1])) for p in points])
+
+
+class TestBatchEvaluation:
+    def test_rgb_default(self, points):
+        assert np.array_equal(PROFILE_DEFAULT.color_for_points(points), scalar_colors(PROFILE_DEFAULT, points))
+
+    def test_rgb_custom(self, points):
+        profile = RGBColorProfile(CUSTOM_PROFILE_RGB)
+        assert np.array_equal(profile.color_for_points(points), scalar_colors(profile, points))
+
+    @pytest.mark.parametrize('config', [
+        CUSTOM_PROFILE_HS,
+        {'mirror_x': False, 'mirror_y': True, 'rotation': -200, 'drop_off': 0},
+        {'mirror_x': True, 'mirror_y': False, 'rotation': 35.5, 'drop_off': 2.5},
+    ])
+    def test_hs(self, points, config):
+        profile = HSColorProfile(config)
+        assert np.array_equal(profile.color_for_points(points), scalar_colors(profile, points))
+
+    def test_hs_saturated(self, points):
+        assert np.array_equal(PROFILE_SATURATED.color_for_points(points), scalar_colors(PROFILE_SATURATED, points))
+
+    def test_hs_table(self):
+        table = hs_rgb_table()
+        for hue in range(360):
+            for saturation in range(101):
+                i = (hue * 101 + saturation) * 3
+                assert tuple(table[i:i + 3]) == hs_to_rgb((hue, saturation))
+        assert hs_to_rgb((360, 50)) == hs_to_rgb((0, 50))
+
+    def test_single_point(self):
+        assert tuple(PROFILE_DEFAULT.color_for_points([(0.2, 0.7)])[0]) == PROFILE_DEFAULT.color_for_point((0.2, 0.7))
+
+    def test_max_brightness(self):
+        colors = np.random.default_rng(0).integers(0, 256, (5000, 3))
+        colors[:100] = colors[:100, :1]  # greys
+        expected = np.array([to_max_brightness((int(c[0]), int(c[1]), int(c[2]))) for c in colors])
+        assert np.array_equal(to_max_brightness_batch(colors), expected)
+
+
+def random_profile(samples, global_weight=2.0, **config):
+    rng = np.random.default_rng(samples)
+    points = rng.random((samples, 2))
+    # colors vary smoothly with the position, like profiles sampled from photographs
+    colors = np.clip(np.stack([points[:, 0], points[:, 1], 1 - points[:, 0]], axis=1) * 255 +
+                     rng.normal(0, 30, (samples, 3)), 0, 255).astype(int)
+    return RGBColorProfile({'global_weight': global_weight, **config, 'sample_data': [
+        {'point': (float(p[0]), float(p[1])), 'color': tuple(int(c) for c in color)}
+        for p, color in zip(points, colors)]})
+
+
+class TestNeighborhood:
+    def test_grid(self):
+        rng = np.random.default_rng(0)
+        samples = [(float(x), float(y)) for x, y in rng.random((500, 2))]
+        grid = SampleGrid(samples)
+        for point in rng.random((50, 2)) * 1.2 - 0.1:
+            point = (float(point[0]), float(point[1]))
+            expected = sorted((squared_distance(point, s), i) for i, s in enumerate(samples))
+            assert grid.nearest(point, 7) == expected[:7]
+            assert sorted(grid.within(point, expected[30][0])) == sorted(i for _, i in expected[:31])
+
+    @pytest.mark.parametrize('config', [{'neighbors': 8}, {'cutoff': 1E-3}, {'neighbors': 32, 'cutoff': 1E-2}])
+    def test_batch_matches_scalar(self, points, config):
+        profile = random_profile(300, **config)
+        assert np.array_equal(profile.color_for_points(points[::4]), scalar_colors(profile, points[::4]))
+
+    def test_all_neighbors(self, points):
+        profile = random_profile(100, neighbors=100)
+        assert np.array_equal(scalar_colors(profile, points[::8]), scalar_colors(random_profile(100), points[::8]))
+
+    def test_cutoff_equivalent(self, points):
+        exact = scalar_colors(random_profile(2000, global_weight=4), points[::20]).astype(int)
+        approximate = scalar_colors(random_profile(2000, global_weight=4, cutoff=1E-3), points[::20]).astype(int)
+        assert np.abs(exact - approximate).max() <= 8
+        assert np.abs(exact - approximate).mean() < 1
+
+    def test_neighborhood_error(self):
+        assert random_profile(100).neighborhood_error() == 0
+        assert random_profile(2000, global_weight=2, neighbors=8).neighborhood_error() > JUST_NOTICEABLE_DIFFERENCE
+        assert random_profile(2000, global_weight=8, cutoff=1E-3).neighborhood_error() < JUST_NOTICEABLE_DIFFERENCE
+
+
+class TestLookupTable:
+    def test_batch_matches_scalar(self, points):
+        profile = LUTColorProfile(PROFILE_DEFAULT, 32)
+        assert np.array_equal(profile.color_for_points(points), scalar_colors(profile, points))
+
+    def test_max_error(self):
+        assert LUTColorProfile(PROFILE_DEFAULT, 16).max_error() > LUTColorProfile(PROFILE_DEFAULT, 128).max_error()
+        assert LUTColorProfile(RGBColorProfile(CUSTOM_PROFILE_RGB), 64).max_error() <= 4
+
+    def test_corners(self):
+        profile = LUTColorProfile(HSColorProfile(CUSTOM_PROFILE_HS), 64)
+        for point in [(0.0, 0.0), (0.0, 1.0), (1.0, 0.0), (1.0, 1.0)]:
+            exact = profile.profile.color_for_point(point)
+            assert all(abs(a - b) <= 1 for a, b in zip(profile.color_for_point(point), exact))
+
+
+class TestColorMapImage:
+    def test_orientation(self):
+        im = create_color_map_image(PROFILE_DEFAULT, 11)
+        assert im.size == (11, 11)
+        assert im.getpixel((0, 0)) == PROFILE_DEFAULT.color_for_point((0.0, 1.0))
+        assert im.getpixel((10, 10)) == PROFILE_DEFAULT.color_for_point((1.0, 0.0))
+        assert im.getpixel((3, 8)) == PROFILE_DEFAULT.color_for_point((0.3, 0.2))
+
+    def test_bands(self):
+        with patch('apps.spotify_mood_lights_sync.spotify_mood_lights_sync.IMAGE_BAND_PIXELS', 7 * 50):
+            banded = create_color_map_image(PROFILE_SATURATED, 50)
+        assert banded.tobytes() == create_color_map_image(PROFILE_SATURATED, 50).tobytes()
+
+    def test_worker_processes(self):
+        with patch('apps.spotify_mood_lights_sync.spotify_mood_lights_sync.IMAGE_BAND_PIXELS', 20 * 64):
+            parallel = create_color_map_image(PROFILE_DEFAULT, 64, workers=2)
+        assert parallel.tobytes() == create_color_map_image(PROFILE_DEFAULT, 64).tobytes()
+
+    def test_fingerprint(self):
+        assert RGBColorProfile(CUSTOM_PROFILE_RGB).fingerprint() == RGBColorProfile(CUSTOM_PROFILE_RGB).fingerprint()
+        assert PROFILE_DEFAULT.fingerprint() != RGBColorProfile(CUSTOM_PROFILE_RGB).fingerprint()
+        assert LUTColorProfile(PROFILE_DEFAULT, 8).fingerprint() != LUTColorProfile(PROFILE_DEFAULT, 16).fingerprint()
+        assert ColorProfile().fingerprint() is None
@@ -0,0 +1,57 @@
+import random
+import string
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import FeatureDataset, write_feature_dataset
+from test_utils import *
+
+TRACK_A = '0' * 21 + 'a'
+TRACK_B = '0' * 21 + 'b'
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    location = str(tmp_path / 'features.bin')
+    write_feature_dataset([
+        (TRACK_A, 'Song 1', ['Artist 1', 'Artist 2'], 0.25, 0.75),
+        (TRACK_B, 'Song 2', ['Artist 1'], 0.123, 0.9),
+        (TRACK_B, 'Song 3', ['Artist 3'], 0.5, 0.5),
+    ], location)
+    dataset = FeatureDataset(location)
+    yield dataset
+    dataset.close()
+
+
+class TestFeatureDataset:
+    def test_features(self, dataset):
+        assert dataset.track_count == 2
+        assert dataset.features('spotify:track:' + TRACK_A) == (0.25, 0.75)
+        assert dataset.features(TRACK_B) == (0.123, 0.9)
+        assert dataset.features('spotify:track:' + '1' * 22) is None
+        assert dataset.features('spotify:track:' + 'a' * 30) is None
+        assert dataset.features('spotify:track:ä') is None
+
+    def test_search(self, dataset):
+        assert dataset.search('Song 1', 'Artist 2') == 'spotify:track:' + TRACK_A
+        assert dataset.search(' song  1', 'ARTIST 1') == 'spotify:track:' + TRACK_A
+        assert dataset.search('Song 3', 'Artist 3') == 'spotify:track:' + TRACK_B
+        assert dataset.search('Song 2', '') == 'spotify:track:' + TRACK_B
+        assert dataset.search('Song 2', 'Artist 2') is None
+
+    def test_many_tracks(self, tmp_path):
+        rng = random.Random(0)
+        tracks = {''.join(rng.choices(string.ascii_letters + string.digits, k=22)): (rng.random(), rng.random())
+                  for _ in range(5000)}
+        location = str(tmp_path / 'features.bin')
+        write_feature_dataset(((track_id, track_id, ['artist'], v, e) for track_id, (v, e) in tracks.items()),
+                              location)
+
+        dataset = FeatureDataset(location)
+        for track_id, (valence, energy) in tracks.items():
+            assert dataset.features(track_id) == pytest.approx((valence, energy), abs=1E-6)
+            assert dataset.search(track_id, 'artist') == 'spotify:track:' + track_id
+        dataset.close()
+
+    def test_invalid_file(self, tmp_path):
+        location = tmp_path / 'features.bin'
+        location.write_bytes(b'not a dataset')
+        with pytest.raises(ValueError):
+            FeatureDataset(str(location))
@@ -27,15 +27,17 @@ def update_passed_args(uut):
 
 
 class TestImageOutput:
-    def test_default_output(self, given_that, update_passed_args):
+    def test_default_output(self, given_that, uut, update_passed_args):
         with update_passed_args():
             given_that.passed_arg('color_map_image').is_set_to({'size': 200, 'location': './out_default.png'})
 
+        uut.image_task.result()
         assert os.path.isfile('./out_default.png')
 
-    def test_hs_default_output(self, given_that, update_passed_args):
+    def test_hs_default_output(self, given_that, uut, update_passed_args):
         with update_passed_args():
             given_that.passed_arg('color_profile').is_set_to('saturated')
             given_that.passed_arg('color_map_image').is_set_to({'size': 200, 'location': './out_hs.png'})
 
+        uut.image_task.result()
         assert os.path.isfile('./out_hs.png')
@@ -1,6 +1,7 @@
 import contextlib
 from appdaemontestframework import automation_fixture
-from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync, search_key, \
+    write_feature_dataset
 from spotipy import Spotify
 from unittest.mock import patch
 from test_utils import *
@@ -92,3 +93,186 @@ class TestColorChange:
         player.update_state('playing', {'title': 'song 1 by artist 1'})
 
         assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+
+class TestSearchCache:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_repeated_song(self, hass_mocks, media_player):
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1'})
+        player.update_state('playing', {'media_title': 'song 2', 'media_artist': 'artist 2'})
+
+        NETWORK_STATE.reset()
+        player.update_state('playing', {'media_title': ' Song 1', 'media_artist': 'ARTIST 1 '})
+
+        assert NETWORK_STATE.tries == 0
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 3
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_title_fallback(self, assert_that, media_player, uut):
+        NETWORK_STATE.turn_off_errors()
+        media_player('media_player.generic_test').update_state('playing', {'media_title': 'song 2',
+                                                                           'media_artist': 'unknown'})
+
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_negative_cache(self, hass_mocks, media_player, uut, hass_errors):
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'unknown', 'media_artist': 'unknown'})
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1'})
+        player.update_state('playing', {'media_title': 'unknown', 'media_artist': 'unknown'})
+
+        assert NETWORK_STATE.tries == 4
+        assert len(hass_errors()) == 2
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+
+
+class TestDebounce:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_attribute_updates_dropped(self, hass_mocks, media_player, uut):
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1', 'media_position': 1})
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1', 'media_position': 2})
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1', 'volume_level': 0.5})
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+        assert uut.stats['dropped_events'] == 2
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_artist_change(self, hass_mocks, media_player):
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1'})
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 2'})
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_burst_coalesced(self, given_that, update_passed_args, hass_mocks, media_player, time_travel,
+                             assert_that, uut):
+        with update_passed_args():
+            given_that.passed_arg('search_debounce').is_set_to(2)
+
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 1'})
+        time_travel.fast_forward(1).seconds()
+        player.update_state('playing', {'media_title': 'song 2', 'media_artist': 'artist 2'})
+        time_travel.fast_forward(1).seconds()
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 2'})
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+        time_travel.fast_forward(2).seconds()
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((1, 1)))
+        assert NETWORK_STATE.tries == 2
+        assert uut.stats['coalesced_events'] == 2
+
+
+class TestFuzzySearch:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_local_match(self, given_that, uut, update_passed_args, media_player, assert_that):
+        with update_passed_args():
+            given_that.passed_arg('fuzzy_search').is_set_to(True)
+
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 2', 'media_artist': 'artist 2'})
+        player.update_state('playing', {'media_title': 'song 1', 'media_artist': 'artist 2'})
+        assert NETWORK_STATE.tries == 4
+
+        player.update_state('playing', {'media_title': 'Song 2 - Remastered 2011', 'media_artist': 'Artist 2 feat. X'})
+        assert NETWORK_STATE.tries == 4
+        assert uut.stats['fuzzy_matches'] == 1
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point(
+            track_to_point('min_max')))
+        assert uut.search_cache.get(search_key('Song 2 - Remastered 2011', 'Artist 2 feat. X')) is None
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_rebuilt_from_cache(self, given_that, uut, update_passed_args, media_player, tmp_path):
+        def search(_, q, type):
+            NETWORK_STATE.inc()
+            artists = [{'name': 'A'}, {'name': 'Y'}]
+            return {'tracks': {'items': [{'uri': 'center', 'name': 'Song (feat. Y)', 'artists': artists}]}}
+
+        location = str(tmp_path / 'cache.db')
+        with update_passed_args():
+            given_that.passed_arg('search_cache').is_set_to({'location': location})
+            given_that.passed_arg('fuzzy_search').is_set_to({'min_similarity': 0.85})
+
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        with patch.object(Spotify, 'search', new=search):
+            player.update_state('playing', {'media_title': 'Other title', 'media_artist': 'A'})
+            uut.terminate()
+            uut.initialize()
+            player.update_state('playing', {'media_title': 'song', 'media_artist': 'Y'})
+        assert NETWORK_STATE.tries == 3  # a single search and the features, which are not cached across restarts
+        assert uut.stats['fuzzy_matches'] == 1
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_disabled_by_default(self, uut, media_player):
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'song 2', 'media_artist': 'artist 2'})
+        player.update_state('playing', {'media_title': 'Song 2!', 'media_artist': 'artist 2'})
+        assert NETWORK_STATE.tries == 4  # both searches for the new title, which are not found
+        assert uut.search_index is None
+
+
+class TestFeatureDataset:
+    @pytest.fixture
+    def dataset(self, given_that, update_passed_args, tmp_path):
+        location = str(tmp_path / 'features.bin')
+        write_feature_dataset([('0' * 21 + 'a', 'song 1', ['artist 1'], 0.0, 1.0)], location)
+        with update_passed_args():
+            given_that.passed_arg('feature_dataset').is_set_to({'location': location, 'api_fallback': False})
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_offline_search(self, dataset, uut, media_player, assert_that, hass_errors):
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.generic_test')
+        player.update_state('playing', {'media_title': 'Song 1', 'media_artist': 'artist 1'})
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0.0, 1.0)))
+
+        player.update_state('playing', {'media_title': 'song 2', 'media_artist': 'artist 2'})
+        assert NETWORK_STATE.tries == 0
+        assert len(hass_errors()) == 1
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_api_fallback(self, dataset, given_that, uut, update_passed_args, media_player, assert_that):
+        with update_passed_args():
+            given_that.passed_arg('feature_dataset').is_set_to({'location': uut.args['feature_dataset']['location']})
+
+        NETWORK_STATE.turn_off_errors()
+        media_player('media_player.generic_test').update_state('playing', {'media_title': 'song 2',
+                                                                           'media_artist': 'artist 2'})
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point(
+            track_to_point('min_max')))
+
+    def test_missing_file(self, given_that, uut, update_passed_args, hass_errors, tmp_path):
+        with update_passed_args():
+            given_that.passed_arg('feature_dataset').is_set_to({'location': str(tmp_path / 'missing.bin')})
+
+        assert uut.feature_dataset is None
+        assert len(hass_errors()) == 1
@@ -0,0 +1,141 @@
+import csv
+import importlib.util
+import io
+import json
+import os
+from unittest.mock import MagicMock
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import *
+from test_utils import *
+
+spec = importlib.util.spec_from_file_location(
+    'map_tracks', os.path.join(os.path.dirname(__file__), os.pardir, 'scripts', 'map_tracks.py'))
+map_tracks = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(map_tracks)
+
+TRACK_A = 'spotify:track:' + '0' * 21 + 'a'
+TRACK_B = 'spotify:track:' + '0' * 21 + 'b'
+TRACK_C = 'spotify:track:' + '0' * 21 + 'c'
+
+
+@pytest.fixture
+def sp():
+    features = {TRACK_A: {'valence': 0.0, 'energy': 1.0}, TRACK_B: {'valence': 1.0, 'energy': 0.0}}
+    found = {'artist:Artist 1 track:Song 1': TRACK_A, 'track:Song 2': TRACK_B}
+
+    sp = MagicMock()
+    sp.audio_features.side_effect = lambda uris: [features.get(uri) for uri in uris]
+    sp.search.side_effect = lambda q, type: {'tracks': {'items': [{'uri': found[q]}] if q in found else []}}
+    return sp
+
+
+@pytest.fixture
+def mapper(sp):
+    mapper = map_tracks.TrackMapper(PROFILE_DEFAULT, PersistentCache(), PersistentCache(table='searches'), sp=sp)
+    yield mapper
+    mapper.close()
+
+
+def run(mapper, text, input_format='text', output_format='csv', batch_size=1000):
+    output = io.StringIO()
+    map_tracks.map_tracks(mapper, io.StringIO(text), output, input_format, output_format, batch_size)
+    return output.getvalue()
+
+
+class TestMapTracks:
+    def test_read_tracks(self):
+        lines = [TRACK_A, 'https://open.spotify.com/track/' + TRACK_B[-22:] + '?si=1', 'Song 1\tArtist 1\n', 'Song 2',
+                 '\n']
+        assert list(map_tracks.read_tracks(lines, 'text')) == [
+            {'uri': TRACK_A}, {'uri': TRACK_B}, {'title': 'Song 1', 'artist': 'Artist 1'},
+            {'title': 'Song 2', 'artist': ''}]
+
+        lines = [json.dumps({'uri': TRACK_A}), json.dumps({'title': 'Song 1', 'artist': 'Artist 1'}), '{}']
+        assert list(map_tracks.read_tracks(lines, 'jsonl')) == [
+            {'uri': TRACK_A}, {'title': 'Song 1', 'artist': 'Artist 1'}]
+
+    def test_csv(self, mapper):
+        rows = list(csv.DictReader(io.StringIO(run(mapper, f'{TRACK_B}\nSong 1\tArtist 1\n'))))
+        assert rows[0] == {'uri': TRACK_B, 'title': '', 'artist': '', 'valence': '1.0', 'energy': '0.0',
+                           'red': '0', 'green': '255', 'blue': '0'}
+        assert rows[1]['uri'] == TRACK_A
+        expected = PROFILE_DEFAULT.color_for_point((0.0, 1.0))
+        assert (rows[1]['red'], rows[1]['green'], rows[1]['blue']) == tuple(str(c) for c in expected)
+
+    def test_jsonl(self, mapper):
+        rows = [json.loads(line) for line in run(mapper, f'{TRACK_C}\nSong 2\tArtist 2\nSong 3\n',
+                                                 output_format='jsonl').splitlines()]
+        assert rows[0] == {'uri': TRACK_C, 'title': None, 'artist': None, 'valence': None, 'energy': None,
+                           'red': None, 'green': None, 'blue': None}
+        assert rows[1]['uri'] == TRACK_B and rows[1]['title'] == 'Song 2'
+        assert (rows[1]['red'], rows[1]['green'], rows[1]['blue']) == PROFILE_DEFAULT.color_for_point((1.0, 0.0))
+        assert rows[2]['uri'] is None
+
+    def test_batched_requests(self, mapper, sp):
+        text = ''.join(f'{TRACK_A}\n{TRACK_B}\n' for _ in range(300))
+        assert len(run(mapper, text, batch_size=250).splitlines()) == 601
+        assert sp.audio_features.call_count == 1
+        assert sp.audio_features.call_args[0][0] == [TRACK_A, TRACK_B]
+
+        mapper.features(f'spotify:track:{i:022d}' for i in range(150))
+        assert [len(call[0][0]) for call in sp.audio_features.call_args_list[1:]] == [100, 50]
+
+    def test_caches(self, mapper, sp):
+        run(mapper, f'{TRACK_A}\nSong 1\tArtist 1\nSong 1\tArtist 1\nSong 4\tArtist 4\n', batch_size=1)
+        assert sp.search.call_count == 3
+        assert sp.audio_features.call_count == 1
+        assert mapper.search_cache.get(search_key('Song 4', 'Artist 4')) == {'uri': None}
+        assert mapper.feature_cache.get(TRACK_A) == [0.0, 1.0]
+
+    def test_retries(self, sp, fake_clock):
+        sp.audio_features.side_effect = [requests.exceptions.ConnectionError(), [{'valence': 0.0, 'energy': 1.0}]]
+        mapper = map_tracks.TrackMapper(PROFILE_DEFAULT, PersistentCache(), PersistentCache(table='searches'), sp=sp,
+                                        retry=RetryPolicy(max_retries=1, base_delay=1))
+        assert mapper.features([TRACK_A]) == {TRACK_A: (0.0, 1.0)}
+        assert len(fake_clock.sleeps) == 1 and 0 <= fake_clock.sleeps[0] <= 1
+
+        sp.audio_features.side_effect = requests.exceptions.ConnectionError()
+        mapper.circuit_breaker = CircuitBreaker(1, 60)
+        assert mapper.features([TRACK_B]) == {}
+        assert mapper.features([TRACK_C]) == {}
+        assert sp.audio_features.call_count == 3  # the open circuit rejects the last request
+        mapper.close()
+
+    def test_offline(self, tmp_path):
+        location = str(tmp_path / 'features.bin')
+        write_feature_dataset([(TRACK_C[-22:], 'Song 5', ['Artist 5'], 0.5, 0.5)], location)
+        dataset = FeatureDataset(location)
+        mapper = map_tracks.TrackMapper(PROFILE_SATURATED, PersistentCache(), PersistentCache(table='searches'),
+                                        feature_dataset=dataset)
+        rows = [json.loads(line) for line in run(mapper, f'Song 5\tArtist 5\n{TRACK_A}\n', 'text',
+                                                 'jsonl').splitlines()]
+        mapper.close()
+        dataset.close()
+
+        assert rows[0]['uri'] == TRACK_C
+        assert (rows[0]['red'], rows[0]['green'], rows[0]['blue']) == PROFILE_SATURATED.color_for_point((0.5, 0.5))
+        assert rows[1]['red'] is None
+
+    def test_profile_parsing(self):
+        errors = []
+        profile = parse_color_profile({'color_profile': 'custom', 'custom_profile': CUSTOM_PROFILE_HS}, errors.append)
+        assert profile.color_for_point((0.2, 0.3)) == HSColorProfile(CUSTOM_PROFILE_HS).color_for_point((0.2, 0.3))
+        assert parse_color_profile({'color_profile': 'custom'}, errors.append) is PROFILE_DEFAULT
+        assert isinstance(parse_color_profile({'color_lookup_table': {'size': 8}}, errors.append), LUTColorProfile)
+        assert len(errors) == 1
+
+    def test_app_config_secrets(self, tmp_path):
+        (tmp_path / 'apps').mkdir()
+        (tmp_path / 'secrets.yaml').write_text('spotify_client_id: id\nspotify_client_secret: secret\n')
+        config = tmp_path / 'apps' / 'apps.yaml'
+        config.write_text('spotify_mood_lights_sync:\n'
+                          '  module: spotify_mood_lights_sync\n'
+                          '  class: SpotifyMoodLightsSync\n'
+                          '  client_id: !secret spotify_client_id\n'
+                          '  client_secret: !secret spotify_client_secret\n')
+
+        app_args = map_tracks.load_app_config(str(config), None)
+        assert (app_args['client_id'], app_args['client_secret']) == ('id', 'secret')
+
+        (tmp_path / 'apps' / 'secrets.yaml').write_text('spotify_client_id: other\n')
+        with pytest.raises(SystemExit, match='spotify_client_secret'):
+            map_tracks.load_app_config(str(config), 'spotify_mood_lights_sync')
@@ -1,8 +1,12 @@
 import contextlib
 import os
+import threading
+from concurrent.futures import BrokenExecutor
 from appdaemontestframework import automation_fixture
-from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import SpotifyMoodLightsSync, LUTColorProfile, \
+    RGBColorProfile, LatencyStats, CircuitBreaker, COMPILED_PROFILES, color_difference
 from spotipy import Spotify
+from spotipy.exceptions import SpotifyException
 from unittest.mock import patch
 from test_utils import *
 
@@ -187,6 +191,101 @@ class TestColorChange:
 
         assert color1 != color2
 
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_color_lookup_table(self, given_that, media_player, uut, assert_that, update_passed_args, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('color_lookup_table').is_set_to({'size': 32, 'report_error': True})
+
+        assert len(hass_errors()) == 0
+        assert isinstance(uut.color_profile, LUTColorProfile)
+
+        media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'center'})
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0.5, 0.5)))
+
+
+class TestCompiledProfiles:
+    def test_shared(self, given_that, uut, uut_empty, update_passed_args):
+        with update_passed_args():
+            given_that.passed_arg('color_profile').is_set_to('custom')
+            given_that.passed_arg('custom_profile').is_set_to(CUSTOM_PROFILE_RGB)
+            given_that.passed_arg('color_lookup_table').is_set_to({'size': 16})
+        profile = uut.color_profile
+
+        uut.initialize()
+        assert uut.color_profile is profile
+
+        uut_empty.args.update(uut.args)
+        uut_empty.initialize()
+        assert uut_empty.color_profile is profile
+
+        with update_passed_args():
+            given_that.passed_arg('color_lookup_table').is_set_to({'size': 32})
+        assert uut.color_profile is not profile
+
+    def test_fallback_not_shared(self, given_that, uut, update_passed_args, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('color_profile').is_set_to('custom')
+            given_that.passed_arg('custom_profile').is_set_to({'color_mode': 'rgb'})
+        uut.initialize()
+
+        assert len(hass_errors()) == 2
+
+    def test_neighbors(self, given_that, uut, update_passed_args, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('color_profile').is_set_to('custom')
+            given_that.passed_arg('custom_profile').is_set_to({**CUSTOM_PROFILE_RGB, 'global_weight': 3,
+                                                               'neighbors': 2, 'cutoff': 0.01})
+
+        assert uut.color_profile.grid is not None
+        assert uut.color_profile.color_for_point((0.0, 0.0)) == (255, 255, 0)
+        # interpolating only two of the few samples is far from the exact profile
+        assert len(hass_errors()) == 1
+        assert 'noticeably change the colors' in hass_errors()[0]
+
+        with update_passed_args():
+            given_that.passed_arg('custom_profile').is_set_to({**CUSTOM_PROFILE_RGB, 'global_weight': 3,
+                                                               'neighbors': len(CUSTOM_PROFILE_RGB['sample_data'])})
+        assert uut.color_profile.grid is not None
+        assert len(hass_errors()) == 1
+
+        with update_passed_args():
+            given_that.passed_arg('custom_profile').is_set_to({**CUSTOM_PROFILE_RGB, 'neighbors': 0})
+        assert uut.color_profile.grid is None
+        assert len(hass_errors()) == 2
+
+    def test_without_numpy(self, given_that, uut, update_passed_args, hass_errors):
+        with patch.dict('sys.modules', {'numpy': None}):
+            with update_passed_args():
+                given_that.passed_arg('color_profile').is_set_to('custom')
+                given_that.passed_arg('custom_profile').is_set_to({**CUSTOM_PROFILE_RGB, 'global_weight': 3,
+                                                                   'neighbors': 2})
+            assert uut.color_profile.color_for_point((0.0, 0.0)) == (255, 255, 0)
+
+            with update_passed_args():
+                given_that.passed_arg('custom_profile').is_set_to(CUSTOM_PROFILE_RGB)
+            assert uut.color_profile.grid is None
+        assert len(hass_errors()) == 0
+
+    def test_persisted_lookup_table(self, given_that, uut, update_passed_args, tmp_path, hass_errors):
+        location = str(tmp_path / 'lut.bin')
+        with update_passed_args():
+            given_that.passed_arg('color_profile').is_set_to('custom')
+            given_that.passed_arg('custom_profile').is_set_to(CUSTOM_PROFILE_RGB)
+            given_that.passed_arg('color_lookup_table').is_set_to({'size': 16, 'location': location})
+        table = uut.color_profile.table
+
+        COMPILED_PROFILES.clear()
+        with patch.object(RGBColorProfile, 'color_for_points') as sample:
+            uut.initialize()
+            sample.assert_not_called()
+        assert uut.color_profile.table == table
+
+        COMPILED_PROFILES.clear()
+        with update_passed_args():
+            given_that.passed_arg('color_lookup_table').is_set_to({'size': 8, 'location': location})
+        assert len(uut.color_profile.table) == 8 * 8 * 3
+        assert len(hass_errors()) == 0
+
 
 class TestSetupErrors:
     @pytest.fixture
@@ -238,16 +337,62 @@ class TestSetupErrors:
 
 
 class TestImageOutput:
-    def test_default_output(self, given_that, update_passed_args):
+    def test_default_output(self, given_that, uut, update_passed_args):
         with update_passed_args():
             given_that.passed_arg('color_map_image').is_set_to({'size': 50, 'location': './out.png'})
 
+        uut.image_task.result()
         assert os.path.isfile('./out.png')
 
-        if os.path.isfile('./out.png'):
-            os.remove('./out.png')
+        for path in ['./out.png', './out.png.hash']:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def test_skip_up_to_date_output(self, given_that, uut, update_passed_args, tmp_path):
+        location = str(tmp_path / 'out.png')
+        with update_passed_args():
+            given_that.passed_arg('color_map_image').is_set_to({'size': 50, 'location': location})
+        uut.image_task.result()
+        assert os.path.isfile(location + '.hash')
+
+        with patch('apps.spotify_mood_lights_sync.spotify_mood_lights_sync.create_color_map_image') as create:
+            uut.initialize()
+            uut.image_task.result()
+            create.assert_not_called()
+
+            with update_passed_args():
+                given_that.passed_arg('color_profile').is_set_to('saturated')
+            uut.image_task.result()
+            create.assert_called_once()
+
+    def test_worker_failure(self, given_that, uut, update_passed_args, tmp_path, hass_errors):
+        location = str(tmp_path / 'out.png')
+        with patch('apps.spotify_mood_lights_sync.spotify_mood_lights_sync.save_color_map_image',
+                   side_effect=[BrokenExecutor(), True]) as save:
+            with update_passed_args():
+                given_that.passed_arg('color_map_image').is_set_to({'size': 50, 'location': location, 'workers': 4})
+            uut.image_task.result()
+
+        assert save.call_args_list[0].args[3] == 4
+        assert len(save.call_args_list[1].args) == 3
+        assert len(hass_errors()) == 1
+
+    def test_background_generation(self, given_that, uut, update_passed_args, tmp_path, assert_that):
+        location = str(tmp_path / 'out.png')
+        generating = threading.Event()
+        with patch('apps.spotify_mood_lights_sync.spotify_mood_lights_sync.save_color_map_image',
+                   side_effect=lambda *_args: generating.wait()):
+            with update_passed_args():
+                given_that.passed_arg('color_map_image').is_set_to({'size': 50, 'location': location})
+
+            assert not uut.image_task.done()
+            assert_that(uut).listens_to.state('media_player.spotify_test', attribute='media_content_id'). \
+                with_callback(uut.sync_lights_from_spotify)
+            generating.set()
+            uut.image_task.result()
 
 
+@pytest.mark.usefixtures('fake_clock')
 class TestRetries:
     @patch.object(Spotify, 'audio_features', new=mock_audio_features)
     def test_retries_default(self, media_player):
@@ -285,3 +430,627 @@ class TestRetries:
         media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
 
         assert NETWORK_STATE.tries == 3
+
+    def test_conflicting_rate_limit(self, given_that, update_passed_args, uut, hass_errors):
+        limiter = uut.rate_limiter
+        with update_passed_args():
+            given_that.passed_arg('rate_limit').is_set_to(2)
+
+        assert uut.rate_limiter is limiter
+        assert limiter.rate == 10
+        assert len(hass_errors()) == 1
+
+    def test_backoff(self, given_that, update_passed_args, media_player, fake_clock, uut):
+        with update_passed_args():
+            given_that.passed_arg('max_retries').is_set_to(4)
+            given_that.passed_arg('retry_base_delay').is_set_to(1)
+            given_that.passed_arg('retry_max_delay').is_set_to(5)
+
+        with patch.object(Spotify, 'audio_features', new=mock_audio_features):
+            NETWORK_STATE.turn_on_errors()
+            media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
+            NETWORK_STATE.turn_off_errors()
+
+        assert len(fake_clock.sleeps) == 4
+        assert all(0 <= delay <= cap for delay, cap in zip(fake_clock.sleeps, [1, 2, 4, 5]))
+        assert uut.stats['retries'] == 4
+
+    def test_retry_after(self, media_player, assert_that, fake_clock, uut):
+        responses = [SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '3'}),
+                     [TRACKS['min_min']]]
+
+        def rate_limited_audio_features(_, track_uri):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with patch.object(Spotify, 'audio_features', new=rate_limited_audio_features):
+            media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
+
+        assert fake_clock.sleeps == [3.0]
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 0)))
+
+    def test_retry_after_too_long(self, hass_mocks, media_player, fake_clock, hass_errors, uut):
+        NETWORK_STATE.reset()
+
+        def rate_limited_audio_features(_, track_uri):
+            NETWORK_STATE.inc()
+            raise SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '3600'})
+
+        player = media_player('media_player.spotify_test')
+        with patch.object(Spotify, 'audio_features', new=rate_limited_audio_features):
+            player.update_state('playing', {'media_content_id': 'min_min'})
+
+        assert fake_clock.sleeps == []
+        assert len(hass_errors()) == 1
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+        # the requested pause holds back later requests without waiting for it
+        with patch.object(Spotify, 'audio_features', new=mock_audio_features):
+            player.update_state('playing', {'media_content_id': 'min_max'})
+            assert NETWORK_STATE.tries == 1
+            assert fake_clock.sleeps == []
+            assert uut.stats['rejected_requests'] == 1
+            assert uut.circuit_breaker.failures == 0
+
+            fake_clock.now += 3600
+            player.update_state('playing', {'media_content_id': 'max_min'})
+            assert NETWORK_STATE.tries == 2
+            assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+
+    def test_retry_after_without_retries(self, given_that, update_passed_args, media_player, fake_clock):
+        with update_passed_args():
+            given_that.passed_arg('max_retries').is_set_to(0)
+
+        def rate_limited_audio_features(_, track_uri):
+            raise SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '3'})
+
+        player = media_player('media_player.spotify_test')
+        with patch.object(Spotify, 'audio_features', new=rate_limited_audio_features):
+            player.update_state('playing', {'media_content_id': 'min_min'})
+        assert fake_clock.sleeps == []
+
+        with patch.object(Spotify, 'audio_features', new=mock_audio_features):
+            player.update_state('playing', {'media_content_id': 'min_max'})
+        assert fake_clock.sleeps == [3.0]
+
+    def test_client_error_not_retried(self, media_player, hass_errors):
+        NETWORK_STATE.reset()
+
+        def bad_request_audio_features(_, track_uri):
+            NETWORK_STATE.inc()
+            raise SpotifyException(400, -1, 'bad request')
+
+        with patch.object(Spotify, 'audio_features', new=bad_request_audio_features):
+            media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
+
+        assert NETWORK_STATE.tries == 1
+        assert len(hass_errors()) == 1
+
+
+class TestCircuitBreaker:
+    @pytest.fixture
+    def outage(self, given_that, update_passed_args, fake_clock):
+        CIRCUIT_BREAKERS.clear()  # the breaker of the default config is kept otherwise, like across app reloads
+        with update_passed_args():
+            given_that.passed_arg('max_retries').is_set_to(0)
+            given_that.passed_arg('circuit_breaker').is_set_to({'failure_threshold': 2, 'reset_timeout': 30})
+            given_that.passed_arg('fallback_color').is_set_to([255, 255, 255])
+        NETWORK_STATE.turn_on_errors()
+        yield fake_clock
+        NETWORK_STATE.turn_off_errors()
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_open(self, uut, media_player, assert_that, hass_errors, outage):
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'min_max'})
+        assert NETWORK_STATE.tries == 2
+        assert uut.circuit_breaker.state == CircuitBreaker.OPEN
+        errors = len(hass_errors())
+
+        player.update_state('playing', {'media_content_id': 'max_min'})
+        assert NETWORK_STATE.tries == 2
+        assert len(hass_errors()) == errors
+        assert uut.stats['rejected_requests'] == 1
+        assert uut.stats['fallback_colors'] == 3
+        assert_that('light.test_light').was.turned_on(rgb_color=(255, 255, 255))
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_cached_features(self, uut, media_player, assert_that, outage):
+        uut.feature_cache.put('center', [0.5, 0.5])
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'min_max'})
+        player.update_state('playing', {'media_content_id': 'center'})
+
+        assert NETWORK_STATE.tries == 2
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0.5, 0.5)))
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_recovery(self, uut, media_player, assert_that, outage):
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'min_max'})
+
+        outage.sleep(30)
+        player.update_state('playing', {'media_content_id': 'max_min'})  # trial request fails
+        assert NETWORK_STATE.tries == 3
+        assert uut.circuit_breaker.state == CircuitBreaker.OPEN
+
+        outage.sleep(30)
+        NETWORK_STATE.turn_off_errors()
+        player.update_state('playing', {'media_content_id': 'max_max'})
+        assert uut.circuit_breaker.state == CircuitBreaker.CLOSED
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((1, 1)))
+
+    def test_conflicting_settings(self, given_that, update_passed_args, uut, hass_errors):
+        breaker = uut.circuit_breaker
+        with update_passed_args():
+            given_that.passed_arg('circuit_breaker').is_set_to({'failure_threshold': 2})
+
+        assert uut.circuit_breaker is breaker
+        assert breaker.failure_threshold == 5
+        assert len(hass_errors()) == 1
+
+    def test_invalid_fallback_color(self, given_that, uut, update_passed_args, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('fallback_color').is_set_to([255, 255])
+        assert uut.fallback_color is None
+        assert len(hass_errors()) == 1
+
+
+class TestFeatureCache:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_repeated_track(self, media_player):
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'min_max'})
+        player.update_state('playing', {'media_content_id': 'min_min'})
+
+        assert NETWORK_STATE.tries == 2
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_persistent_cache(self, given_that, uut, update_passed_args, media_player, assert_that, tmp_path):
+        with update_passed_args():
+            given_that.passed_arg('feature_cache').is_set_to({'location': str(tmp_path / 'features.db')})
+
+        NETWORK_STATE.turn_off_errors()
+        media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
+        uut.terminate()
+        uut.initialize()
+
+        NETWORK_STATE.reset()
+        given_that.mock_functions_are_cleared()
+        media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_min'})
+
+        assert NETWORK_STATE.tries == 0
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 0)))
+
+
+class TestPrefetch:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_album(self, given_that, uut, update_passed_args, assert_that, media_player):
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'context_attribute': 'media_context_uri'})
+
+        assert_that(uut). \
+            listens_to.state('media_player.spotify_test', attribute='media_context_uri'). \
+            with_callback(uut.prefetch_from_context)
+
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        uut.prefetch_from_context('media_player.spotify_test', 'media_context_uri', None, 'spotify:album:min', None)
+        assert NETWORK_STATE.tries == 2
+
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'min_max'})
+        assert NETWORK_STATE.tries == 2
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_on_worker(self, given_that, uut, update_passed_args):
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'context_attribute': 'media_context_uri'})
+            given_that.passed_arg('worker_threads').is_set_to(2)
+
+        threads = []
+
+        def context_track_uris(context_uri):
+            threads.append(threading.current_thread())
+            return CONTEXTS[context_uri]
+
+        NETWORK_STATE.turn_off_errors()
+        with patch.object(uut, 'context_track_uris', new=context_track_uris):
+            uut.prefetch_from_context('media_player.spotify_test', 'media_context_uri', None, 'spotify:album:min',
+                                      None)
+            uut.executor.shutdown(wait=True)
+        assert len(threads) == 1 and threads[0] is not threading.current_thread()
+        assert uut.feature_cache.get('min_max') == [0, 1]
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'playlist_items', new=mock_playlist_items)
+    @patch.object(Spotify, 'next', new=mock_next)
+    def test_playlist_pages(self, uut):
+        NETWORK_STATE.turn_off_errors()
+        assert uut.context_track_uris('spotify:playlist:all') == CONTEXTS['spotify:playlist:all']
+
+        NETWORK_STATE.reset()
+        assert uut.prefetch_features(CONTEXTS['spotify:playlist:all']) == 6
+        assert NETWORK_STATE.tries == 1
+        assert uut.feature_cache.get('center') == [0.5, 0.5]
+        assert uut.feature_cache.get('not_found') is None
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'playlist_items', new=mock_playlist_items)
+    @patch.object(Spotify, 'next', new=mock_next)
+    def test_local_files_and_episodes(self, uut, hass_errors):
+        NETWORK_STATE.turn_off_errors()
+        assert uut.context_track_uris('spotify:playlist:mixed') == ['min_min', 'max_max']
+
+        uut.prefetch_from_context('media_player.spotify_test', 'media_context_uri', None, 'spotify:playlist:mixed',
+                                  None)
+        assert len(hass_errors()) == 0
+        assert uut.feature_cache.get('max_max') == [1, 1]
+        assert uut.prefetch_features(CONTEXTS['spotify:playlist:mixed']) == 0
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_next_track(self, given_that, uut, update_passed_args, assert_that, media_player):
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'context_attribute': 'media_context_uri', 'next_track': True})
+
+        NETWORK_STATE.turn_off_errors()
+        NETWORK_STATE.reset()
+        player = media_player('media_player.spotify_test')
+        attributes = {'media_context_uri': 'spotify:album:min', 'shuffle': False, 'repeat': 'all'}
+        player.update_state('playing', {**attributes, 'media_content_id': 'min_min'})
+        assert NETWORK_STATE.tries == 3
+        predicted = uut.predicted_colors['media_player.spotify_test']
+        assert predicted == ('min_min', 'min_max', uut.color_profile.color_for_point((0, 1)))
+
+        with patch.object(uut.color_profile, 'color_for_point', wraps=uut.color_profile.color_for_point) as lookup:
+            player.update_state('playing', {**attributes, 'media_content_id': 'min_max'})
+            assert lookup.call_count == 1  # only the prediction of the following track
+        assert NETWORK_STATE.tries == 3
+        assert uut.stats['predicted_tracks'] == 1
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+        assert uut.predicted_colors['media_player.spotify_test'][:2] == ('min_max', 'min_min')
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_next_track_unpredictable(self, given_that, uut, update_passed_args, media_player, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'context_attribute': 'media_context_uri', 'next_track': True})
+
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_context_uri': 'spotify:album:min', 'shuffle': True,
+                                        'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_context_uri': 'spotify:album:min', 'repeat': 'off',
+                                        'media_content_id': 'min_max'})
+        assert uut.predicted_colors == {}
+        assert len(hass_errors()) == 0
+
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'next_track': True})
+        assert not uut.predict_next_track
+        assert len(hass_errors()) == 1
+
+    @pytest.fixture
+    def playing(self, uut, given_that, update_passed_args, media_player):
+        with update_passed_args():
+            given_that.passed_arg('prefetch').is_set_to({'context_attribute': 'media_context_uri', 'next_track': True,
+                                                         'schedule_next_track': True})
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.spotify_test')
+
+        def update(state, track_uri, position):
+            attributes = {'media_context_uri': 'spotify:album:min', 'media_content_id': track_uri,
+                          'media_duration': 100, 'media_position': position,
+                          'media_position_updated_at': uut.datetime().isoformat()}
+            player.update_state(state, attributes)
+            uut.schedule_track_end(player.entity, 'all', {}, {'state': state, 'attributes': attributes}, None)
+
+        return update
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_schedule_track_end(self, uut, assert_that, hass_mocks, playing, time_travel):
+        assert_that(uut). \
+            listens_to.state('media_player.spotify_test', attribute='all'). \
+            with_callback(uut.schedule_track_end)
+
+        next_color = uut.color_profile.color_for_point((0, 1))
+        playing('playing', 'min_min', 10)
+        time_travel.fast_forward(50).seconds()
+        playing('playing', 'min_min', 55)  # ran ahead by 5 seconds, the track now ends at 95 seconds
+        time_travel.fast_forward(44).seconds()
+        assert_that('light.test_light').was_not.turned_on(rgb_color=next_color)
+
+        time_travel.fast_forward(2).seconds()
+        assert_that('light.test_light').was.turned_on(rgb_color=next_color)
+        assert uut.stats['early_track_changes'] == 1
+
+        # updates of the ended track, e.g. of the volume, do not apply the color again
+        playing('playing', 'min_min', 100)
+        time_travel.fast_forward(1).seconds()
+        assert uut.track_end_timers['media_player.spotify_test'][2] is None
+        assert uut.stats['early_track_changes'] == 1
+
+        NETWORK_STATE.reset()
+        turn_on = hass_mocks.hass_functions['turn_on']
+        calls = turn_on.call_count
+        playing('playing', 'min_max', 0)
+        assert turn_on.call_count == calls
+        assert NETWORK_STATE.tries == 0
+        assert uut.track_end_timers['media_player.spotify_test'][0] == 'min_max'
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_schedule_cancelled(self, uut, assert_that, playing, time_travel):
+        next_color = uut.color_profile.color_for_point((0, 1))
+        playing('playing', 'min_min', 10)
+        time_travel.fast_forward(10).seconds()
+        playing('paused', 'min_min', 20)
+        assert uut.track_end_timers == {}
+        time_travel.fast_forward(100).seconds()
+        assert_that('light.test_light').was_not.turned_on(rgb_color=next_color)
+
+        playing('playing', 'min_min', 90)
+        time_travel.fast_forward(5).seconds()
+        playing('playing', 'min_min', 5)  # seeked back
+        time_travel.fast_forward(10).seconds()
+        assert_that('light.test_light').was_not.turned_on(rgb_color=next_color)
+        time_travel.fast_forward(90).seconds()
+        assert_that('light.test_light').was.turned_on(rgb_color=next_color)
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'album_tracks', new=mock_album_tracks)
+    def test_prediction_of_other_track(self, uut, assert_that, playing, time_travel):
+        playing('playing', 'min_min', 10)
+        color = uut.color_profile.color_for_point((1, 1))
+        # a late lookup of the track that played before
+        uut.predicted_colors['media_player.spotify_test'] = ('max_min', 'max_max', color)
+        time_travel.fast_forward(100).seconds()
+
+        assert_that('light.test_light').was_not.turned_on(rgb_color=color)
+        assert uut.stats['early_track_changes'] == 0
+
+    def test_unsupported_context(self, uut):
+        NETWORK_STATE.reset()
+        assert uut.context_track_uris('spotify:artist:abc') == []
+        assert NETWORK_STATE.tries == 0
+
+
+class TestWorkerPool:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_lookup_on_worker(self, given_that, uut, update_passed_args, assert_that, media_player):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(2)
+
+        NETWORK_STATE.turn_off_errors()
+        media_player('media_player.spotify_test').update_state('playing', {'media_content_id': 'min_max'})
+        uut.executor.shutdown(wait=True)
+
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+
+    def test_drop_stale_lookup(self, given_that, uut, update_passed_args, hass_mocks, assert_that, media_player):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(2)
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_audio_features(_, track_uris):
+            if track_uris == ['min_min']:
+                started.set()
+                release.wait(5)
+            return [TRACKS[track_uri] for track_uri in track_uris]
+
+        with patch.object(Spotify, 'audio_features', new=slow_audio_features):
+            player = media_player('media_player.spotify_test')
+            player.update_state('playing', {'media_content_id': 'min_min'})
+            started.wait(5)
+            player.update_state('playing', {'media_content_id': 'max_max'})
+            release.set()
+            uut.executor.shutdown(wait=True)
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+        assert_that('light.test_light').was.turned_on(rgb_color=uut.color_profile.color_for_point((1, 1)))
+        assert uut.stats['stale_lookups'] == 1
+
+    def test_count_from_threads(self, uut):
+        threads = [threading.Thread(target=lambda: [uut.count('retries') for _ in range(1000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert uut.stats['retries'] == 8000
+
+    def test_deduplicate_lookups(self, given_that, uut, update_passed_args, assert_that):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(2)
+            given_that.passed_arg('media_player').is_set_to(None)
+            given_that.passed_arg('light').is_set_to(None)
+            given_that.passed_arg('rooms').is_set_to([
+                {'media_player': 'media_player.kitchen', 'light': 'light.kitchen'},
+                {'media_player': 'media_player.bedroom', 'light': 'light.bedroom'},
+            ])
+
+        release = threading.Event()
+        calls = []
+
+        def slow_audio_features(_, track_uris):
+            calls.append(track_uris)
+            release.wait(5)
+            return [TRACKS[track_uri] for track_uri in track_uris]
+
+        with patch.object(Spotify, 'audio_features', new=slow_audio_features):
+            uut.sync_lights_from_spotify('media_player.kitchen', 'media_content_id', None, 'min_max', None)
+            uut.sync_lights_from_spotify('media_player.bedroom', 'media_content_id', None, 'min_max', None)
+            for _ in range(500):
+                if uut.single_flight.shared:
+                    break
+                time.sleep(0.01)
+            release.set()
+            uut.executor.shutdown(wait=True)
+
+        assert calls == [['min_max']]
+        assert uut.stats['deduplicated_calls'] == 1
+        assert_that('light.kitchen').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+        assert_that('light.bedroom').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+
+
+class TestRooms:
+    @pytest.fixture
+    def rooms(self, given_that, uut, update_passed_args):
+        with update_passed_args():
+            given_that.passed_arg('media_player').is_set_to(None)
+            given_that.passed_arg('light').is_set_to(None)
+            given_that.passed_arg('rooms').is_set_to([
+                {'media_player': 'media_player.kitchen', 'light': 'light.kitchen'},
+                {'media_player': 'media_player.bedroom', 'light': 'light.bedroom', 'mode': 'search'},
+            ])
+
+    @pytest.mark.usefixtures('rooms')
+    def test_callbacks(self, uut, assert_that, hass_errors):
+        assert len(hass_errors()) == 0
+        assert_that(uut). \
+            listens_to.state('media_player.kitchen', attribute='media_content_id'). \
+            with_callback(uut.sync_lights_from_spotify)
+        assert_that(uut). \
+            listens_to.state('media_player.bedroom', attribute='all'). \
+            with_callback(uut.sync_lights_from_search)
+
+    @pytest.mark.usefixtures('rooms')
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    @patch.object(Spotify, 'search', new=mock_search)
+    def test_independent_rooms(self, uut, assert_that, hass_mocks):
+        NETWORK_STATE.turn_off_errors()
+        uut.sync_lights_from_spotify('media_player.kitchen', 'media_content_id', None, 'min_max', None)
+        uut.sync_lights_from_search('media_player.bedroom', None, {'attributes': {}},
+                                    {'attributes': {'media_title': 'song 1', 'media_artist': 'artist 2'}}, None)
+        uut.executor.shutdown(wait=True)
+
+        assert_that('light.kitchen').was.turned_on(rgb_color=uut.color_profile.color_for_point((0, 1)))
+        assert_that('light.bedroom').was.turned_on(rgb_color=uut.color_profile.color_for_point((1, 1)))
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+
+    @pytest.mark.usefixtures('rooms')
+    def test_worker_per_room(self, given_that, uut, update_passed_args):
+        assert uut.executor._max_workers == 2
+
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(0)
+        assert uut.executor is None
+
+    def test_invalid_room(self, given_that, uut, update_passed_args, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('rooms').is_set_to([{'light': 'light.kitchen'},
+                                                      {'media_player': 'media_player.kitchen'}])
+
+        assert len(hass_errors()) == 2
+        assert list(uut.rooms) == ['media_player.kitchen']
+
+    def test_shared_client(self, given_that, uut, update_passed_args):
+        client = uut.sp
+        with update_passed_args():
+            given_that.passed_arg('color_profile').is_set_to('saturated')
+
+        assert uut.sp is client
+
+
+class TestColorDifference:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_similar_color_skipped(self, given_that, uut, update_passed_args, hass_mocks, media_player):
+        with update_passed_args():
+            given_that.passed_arg('min_color_difference').is_set_to(5)
+
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        with patch.dict(TRACKS, {'almost_min_min': {'valence': 0.01, 'energy': 0.01}}):
+            player.update_state('playing', {'media_content_id': 'almost_min_min'})
+        player.update_state('playing', {'media_content_id': 'max_max'})
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+        assert uut.stats['suppressed_colors'] == 1
+
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_light_turned_off(self, given_that, uut, update_passed_args, hass_mocks, media_player):
+        with update_passed_args():
+            given_that.passed_arg('min_color_difference').is_set_to(5)
+
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        given_that.state_of('light.test_light').is_set_to('off')
+        with patch.dict(TRACKS, {'almost_min_min': {'valence': 0.01, 'energy': 0.01}}):
+            player.update_state('playing', {'media_content_id': 'almost_min_min'})
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+
+    def test_color_difference(self):
+        assert color_difference((255, 0, 0), (255, 0, 0)) == 0
+        assert color_difference((255, 0, 0), (254, 1, 0)) < 2.3
+        assert color_difference((255, 0, 0), (255, 60, 0)) > 2.3
+
+
+class TestLatencyStats:
+    @patch.object(Spotify, 'audio_features', new=mock_audio_features)
+    def test_sensor(self, given_that, uut, update_passed_args, hass_mocks, media_player):
+        with update_passed_args():
+            given_that.passed_arg('latency_stats').is_set_to({'entity': 'sensor.lights_latency'})
+
+        NETWORK_STATE.turn_off_errors()
+        player = media_player('media_player.spotify_test')
+        player.update_state('playing', {'media_content_id': 'min_min'})
+        player.update_state('playing', {'media_content_id': 'max_max'})
+        uut.publish_latency({})
+
+        entity, kwargs = hass_mocks.hass_functions['set_state'].call_args
+        assert entity == ('sensor.lights_latency',)
+        assert kwargs['state'] == kwargs['attributes']['total_p95']
+        for stage in ['event', 'audio_features', 'color_for_point', 'turn_on', 'total']:
+            assert kwargs['attributes'][f'{stage}_count'] == 2
+            assert 0 <= kwargs['attributes'][f'{stage}_p50'] <= kwargs['attributes'][f'{stage}_p99']
+        assert kwargs['attributes']['search_count'] == 0
+
+    def test_prometheus_file(self, given_that, uut, update_passed_args, tmp_path, hass_errors):
+        location = str(tmp_path / 'metrics.prom')
+        with update_passed_args():
+            given_that.passed_arg('latency_stats').is_set_to({'prometheus_file': location})
+
+        uut.latency.record('turn_on', 0.25)
+        uut.stats['retries'] += 1
+        uut.publish_latency({})
+
+        with open(location) as f:
+            text = f.read()
+        assert 'stage="turn_on",quantile="0.95"} 0.25\n' in text
+        assert 'spotify_mood_lights_sync_latency_seconds_count{app="' in text
+        assert 'event="retries"} 1\n' in text
+        assert len(hass_errors()) == 0
+
+    @pytest.mark.parametrize('latency_stats, errors', [(False, 0), (None, 0), ('sensor.lights_latency', 1)])
+    def test_disabled(self, given_that, uut, update_passed_args, hass_errors, latency_stats, errors):
+        with update_passed_args():
+            given_that.passed_arg('latency_stats').is_set_to(latency_stats)
+
+        assert uut.latency_entity is None
+        assert len(hass_errors()) == errors
+
+    def test_percentiles(self):
+        stats = LatencyStats(window=100)
+        for i in range(1, 201):
+            stats.record('search', i)
+
+        assert stats.percentiles('search') == {0.5: 150, 0.95: 195, 0.99: 199}
+        assert stats.counts['search'] == 200
+        assert stats.percentiles('turn_on') == {}
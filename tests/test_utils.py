@@ -1,7 +1,10 @@
 import pytest
 import re
+import time
+from unittest.mock import patch
 
 import requests
+from apps.spotify_mood_lights_sync.spotify_mood_lights_sync import CIRCUIT_BREAKERS, RATE_LIMITERS, SINGLE_FLIGHTS
 
 TRACKS = {
     "min_min": {"valence": 0, "energy": 0},
@@ -74,28 +77,87 @@ def track_to_point(track_uri):
     return TRACKS[track_uri]['valence'], TRACKS[track_uri]['energy']
 
 
-def mock_audio_features(_, track_uri):
+CONTEXTS = {
+    "spotify:album:min": ["min_min", "min_max"],
+    "spotify:playlist:all": list(TRACKS.keys()) + ["not_found"],
+    "spotify:playlist:mixed": ["spotify:local:artist:album:song:180", "min_min", "spotify:episode:abc", "max_max"],
+}
+
+
+def mock_audio_features(_, tracks):
+    NETWORK_STATE.inc()
+
+    tracks = tracks if isinstance(tracks, list) else [tracks]
+    if any(track_uri.startswith(('spotify:local:', 'spotify:episode:')) for track_uri in tracks):
+        # like spotipy, which fails to parse the id of these uris
+        from spotipy.exceptions import SpotifyException
+        raise SpotifyException(400, -1, 'Unsupported URL / URI.')
+
+    return [TRACKS.get(track_uri) for track_uri in tracks]
+
+
+def mock_album_tracks(_, album_id, limit=50):
+    NETWORK_STATE.inc()
+
+    return {'items': [{'uri': track_uri} for track_uri in CONTEXTS[album_id]], 'next': None}
+
+
+def mock_playlist_items(_, playlist_id, fields=None, additional_types=('track',)):
+    NETWORK_STATE.inc()
+
+    tracks = CONTEXTS[playlist_id]
+    return {'items': [{'track': {'uri': track_uri}} for track_uri in tracks[:3]], 'next': tracks[3:] or None}
+
+
+def mock_next(_, result):
     NETWORK_STATE.inc()
 
-    if track_uri not in TRACKS:
-        return [None]
-    return [TRACKS[track_uri]]
+    return {'items': [{'track': {'uri': track_uri}} for track_uri in result['next']], 'next': None}
 
 
 def mock_search(_, q, type):
     NETWORK_STATE.inc()
 
-    groups = re.match(r"artist:(.*)track:(.*)", q).groups()
-    if len(groups) == 1:
-        pass
+    match = re.match(r"artist:(.*)track:(.*)", q)
+    if match is None:
+        title = re.match(r"track:(.*)", q).group(1).strip()
+        uris = [uri for (song, _artist), uri in SONGS.items() if song == title][:1]
     else:
-        return {'tracks': {
-            'items': [{
-                'uri': SONGS[(groups[1].strip(), groups[0].strip())]
-            }]
-        }}
+        song = (match.group(2).strip(), match.group(1).strip())
+        uris = [SONGS[song]] if song in SONGS else []
+
+    return {'tracks': {
+        'items': [{'uri': uri} for uri in uris]
+    }}
 
 
 @pytest.fixture
 def hass_errors(hass_mocks):
     return lambda: [call[0][0] for call in hass_mocks.hass_functions["error"].call_args_list]
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limiters():
+    RATE_LIMITERS.clear()
+    CIRCUIT_BREAKERS.clear()
+    SINGLE_FLIGHTS.clear()
+
+
+@pytest.fixture
+def fake_clock():
+    """Replaces sleeping with advancing a fake monotonic clock."""
+    class FakeClock:
+        def __init__(self):
+            self.now = time.monotonic()
+            self.sleeps = []
+
+        def monotonic(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    clock = FakeClock()
+    with patch('time.monotonic', new=clock.monotonic), patch('time.sleep', new=clock.sleep):
+        yield clock